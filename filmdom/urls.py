@@ -1,6 +1,6 @@
 from django.urls import include, path
 from rest_framework import routers
-from filmdom_mvp import views
+from filmdom_mvp import async_views, views
 from filmdom import settings
 from django.conf.urls.static import static
 from django.contrib import admin
@@ -19,12 +19,22 @@ admin.site.register(models.MovieGenre)
 admin.site.register(models.Movie)
 admin.site.register(models.Comment)
 admin.site.register(models.Director)
+admin.site.register(models.IngestionRun)
+admin.site.register(models.Leaderboard)
 
 urlpatterns = [
     path("", include(router.urls)),
     path('admin/', admin.site.urls),
     path("api-token-auth/", views.MyAuthToken.as_view()),
     path("auth/", views.AuthTestView.as_view()),
+    # read only endpoints for ASGI deployments
+    path("async/movies/", async_views.movie_list),
+    path("async/movies/<int:pk>/", async_views.movie_detail),
+    path("async/comments/", async_views.comment_list),
+    path("async/comments/<int:pk>/", async_views.comment_detail),
+    path("async/directors/", async_views.director_list),
+    path("async/actors/", async_views.actor_list),
+    path("async/genres/", async_views.genre_list),
 ]
 
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
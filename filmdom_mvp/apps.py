@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class FilmdomMvpConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "filmdom_mvp"
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from . import search
+
+        post_migrate.connect(search.create_trigram_index, sender=self)
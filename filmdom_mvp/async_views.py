@@ -0,0 +1,50 @@
+"""
+Async read endpoints mounted under /async/ for ASGI deployments.
+
+Django 3.2 has no async ORM, so the views run the regular viewsets
+(same filters, caching, pagination and fieldsets) in the shared thread
+pool of `sync_to_async(thread_sensitive=False)`. Sync views under ASGI
+all go through a single thread, so a slow query there holds up every
+other request. Here it only holds up its own worker thread.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpResponseNotAllowed
+from . import views
+
+READ_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+
+def async_read_view(viewset, actions: dict):
+    view = viewset.as_view(actions)
+
+    def respond(request, *args, **kwargs):
+        # worker threads do not see the request_started/finished
+        # signals, connections are recycled here instead
+        close_old_connections()
+        try:
+            response = view(request, *args, **kwargs)
+            return response.render()
+        finally:
+            close_old_connections()
+
+    async def async_view(request, *args, **kwargs):
+        if request.method not in READ_METHODS:
+            return HttpResponseNotAllowed(READ_METHODS)
+
+        return await sync_to_async(respond, thread_sensitive=False)(
+            request, *args, **kwargs
+        )
+
+    async_view.csrf_exempt = True
+    return async_view
+
+
+movie_list = async_read_view(views.MovieViewSet, {"get": "list"})
+movie_detail = async_read_view(views.MovieViewSet, {"get": "retrieve"})
+comment_list = async_read_view(views.CommentViewSet, {"get": "list"})
+comment_detail = async_read_view(views.CommentViewSet, {"get": "retrieve"})
+director_list = async_read_view(views.DirectorViewSet, {"get": "list"})
+actor_list = async_read_view(views.ActorViewSet, {"get": "list"})
+genre_list = async_read_view(views.MovieGenreViewSet, {"get": "list"})
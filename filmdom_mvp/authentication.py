@@ -0,0 +1,110 @@
+"""
+Token authentication with the token lookup cached in process.
+
+Tokens are kept in a bounded LRU for AUTH_TOKEN_CACHE_TTL seconds, so
+the hot path of an authenticated request costs no query. With
+AUTH_TOKEN_SHARED_CACHE the entries are stored in the shared cache as
+well and other processes miss their LRU less often.
+
+Entries are dropped when a token is deleted or its user is saved (e.g.
+deactivated), see signals.py. The LRU of other processes only learns
+about it when its entry expires, which bounds how long a revoked token
+keeps working to the TTL.
+"""
+
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+from typing import Optional
+import copy
+import threading
+import time
+
+SHARED_KEY = "auth-token:{}"
+
+
+class TokenCache:
+    """
+    LRU of at most `size` entries, each valid for `ttl` seconds
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: tuple):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache(
+    settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL
+)
+
+
+def forget_token(key: str):
+    token_cache.delete(key)
+
+    if settings.AUTH_TOKEN_SHARED_CACHE:
+        cache.delete(SHARED_KEY.format(key))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication answering from the token cache. Invalid tokens
+    and inactive users are never cached, they go to the database
+    and fail there.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+
+        if cached is None and settings.AUTH_TOKEN_SHARED_CACHE:
+            cached = cache.get(SHARED_KEY.format(key))
+            if cached is not None:
+                token_cache.set(key, cached)
+
+        if cached is None:
+            cached = super().authenticate_credentials(key)
+            token_cache.set(key, cached)
+
+            if settings.AUTH_TOKEN_SHARED_CACHE:
+                cache.set(
+                    SHARED_KEY.format(key),
+                    cached,
+                    settings.AUTH_TOKEN_CACHE_TTL,
+                )
+
+        # requests may modify their user, the cached one stays intact
+        user, token = cached
+        return copy.copy(user), token
@@ -0,0 +1,64 @@
+"""
+Batch lookups: `?ids=3,1,2` returns the listed objects in one
+unpaginated response, in the requested order. Ids of missing objects
+are left out.
+"""
+
+from django.conf import settings
+from django.db.models import Case, IntegerField, Value, When
+from rest_framework.exceptions import ValidationError
+from typing import List, Optional
+
+# ids of BigAutoField primary keys, larger ones do not fit a query
+# parameter
+MAX_ID = 2**63 - 1
+
+
+class BatchLookupMixin:
+    ids_query_param = "ids"
+
+    def requested_ids(self) -> Optional[List[int]]:
+        value = self.request.query_params.get(self.ids_query_param)
+
+        if value is None:
+            return None
+
+        try:
+            ids = [int(id) for id in value.split(",") if id.strip()]
+            if not all(0 < id <= MAX_ID for id in ids):
+                raise ValueError("Id out of range")
+        except ValueError:
+            raise ValidationError(
+                f"{self.ids_query_param} has to be a comma separated "
+                "list of integers"
+            )
+
+        # repeated ids are returned once, at their first position
+        ids = list(dict.fromkeys(ids))
+
+        if len(ids) > settings.BATCH_LOOKUP_MAX_IDS:
+            raise ValidationError(
+                f"At most {settings.BATCH_LOOKUP_MAX_IDS} ids "
+                "can be looked up at once"
+            )
+
+        return ids
+
+    def filter_requested_ids(self, queryset, ids: List[int]):
+        """
+        Narrows the queryset to the ids, ordered as requested
+        """
+        self._paginator = None
+
+        if not ids:
+            return queryset.none()
+
+        position = Case(
+            *[When(id=id, then=Value(i)) for i, id in enumerate(ids)],
+            output_field=IntegerField(),
+        )
+        return (
+            queryset.filter(id__in=ids)
+            .annotate(requested_position=position)
+            .order_by("requested_position")
+        )
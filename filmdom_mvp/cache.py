@@ -0,0 +1,139 @@
+"""
+Versioned response cache of the read only catalog endpoints.
+
+Every cached response is stored under a key containing the current
+versions of the data it was built from. Changing the data only bumps
+the versions (see signals.py and tasks.py), the outdated responses
+are never looked up again and simply expire.
+
+The versions are bumped by the Celery worker and by any web process,
+so they only reach the others through a shared cache (see
+MEMCACHED_LOCATION in the settings). With a cache local to the process
+CATALOG_CACHE_TIMEOUT defaults to 0 and enabling it is reported by
+`manage.py check`.
+"""
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+from hashlib import md5
+import time
+
+VERSION_KEY = "catalog-version:{}"
+
+
+def new_version() -> int:
+    # time based, so a version lost to eviction is never reused
+    return time.time_ns()
+
+
+def get_versions(*namespaces: str) -> list:
+    keys = [VERSION_KEY.format(ns) for ns in namespaces]
+    versions = cache.get_many(keys)
+
+    missing = {key: new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+
+    return [versions[key] for key in keys]
+
+
+def bump_versions(*namespaces: str):
+    cache.set_many(
+        {VERSION_KEY.format(ns): new_version() for ns in namespaces}, None
+    )
+
+
+def bump_versions_on_commit(*namespaces: str):
+    """
+    Bumps the versions once the current transaction commits, a request
+    in between would otherwise cache the old data under the new ones
+    """
+    transaction.on_commit(lambda: bump_versions(*namespaces))
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES["default"]["BACKEND"]
+
+    if settings.CATALOG_CACHE_TIMEOUT == 0 or not backend.endswith(
+        "LocMemCache"
+    ):
+        return []
+
+    return [
+        checks.Warning(
+            "The catalog response cache is enabled on a cache local to "
+            "the process, the other processes' writes do not invalidate "
+            "its responses.",
+            hint="Set MEMCACHED_LOCATION or CATALOG_CACHE_TIMEOUT = 0.",
+            id="filmdom_mvp.W001",
+        )
+    ]
+
+
+class CachedResponseMixin:
+    """
+    Caches list and detail responses of a read only viewset.
+
+    `cache_namespaces` are the versions a list response depends on.
+    Detail responses depend on `detail_cache_namespaces` (the same ones
+    by default) and on the `<namespace>:<pk>` version of the object.
+    The `cached_headers` of a response are cached along with its data.
+    """
+
+    cache_namespaces = ()
+    detail_cache_namespaces = None
+    cached_headers = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            self.cache_namespaces, super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        base = self.detail_cache_namespaces or self.cache_namespaces
+        lookup = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        namespaces = base + (f"{base[0]}:{lookup}",)
+        return self.cached_response(
+            namespaces, super().retrieve, request, *args, **kwargs
+        )
+
+    def is_cacheable(self, request) -> bool:
+        return settings.CATALOG_CACHE_TIMEOUT != 0
+
+    def get_cache_key(self, request, namespaces) -> str:
+        params = sorted(request.query_params.lists())
+        versions = get_versions(*namespaces)
+        raw = f"{request.build_absolute_uri(request.path)}|{params}|{versions}"
+        return "catalog-response:" + md5(raw.encode("utf-8")).hexdigest()
+
+    def cached_response(self, namespaces, view, request, *args, **kwargs):
+        if not self.is_cacheable(request):
+            return view(request, *args, **kwargs)
+
+        key = self.get_cache_key(request, namespaces)
+        cached = cache.get(key)
+
+        if cached is not None:
+            data, status, headers = cached
+            return Response(data, status=status, headers=headers)
+
+        response = view(request, *args, **kwargs)
+
+        if response.status_code == 200:
+            headers = {
+                name: response[name]
+                for name in self.cached_headers
+                if response.has_header(name)
+            }
+            cache.set(
+                key,
+                (response.data, response.status_code, headers),
+                settings.CATALOG_CACHE_TIMEOUT,
+            )
+
+        return response
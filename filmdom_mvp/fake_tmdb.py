@@ -0,0 +1,139 @@
+"""
+Local stand-in of the TMDB API, used to benchmark and test the
+ingestion without hitting the real service.
+
+It serves a synthetic gzipped export of `movies` entries together with
+the movie detail and genre list endpoints. Every request can be
+delayed by `latency` seconds and fails with `error_rate` probability,
+half of the failures being throttled (429) responses.
+
+Point TMDB_API_URL to `<server>/3` and TMDB_EXPORT_URL to
+`<server>/p/exports` to fetch from it.
+"""
+
+from aiohttp import web
+from typing import Optional
+import asyncio
+import gzip
+import json
+import random
+
+GENRES = [
+    {"id": 28, "name": "Action"},
+    {"id": 12, "name": "Adventure"},
+    {"id": 35, "name": "Comedy"},
+    {"id": 18, "name": "Drama"},
+    {"id": 27, "name": "Horror"},
+    {"id": 10749, "name": "Romance"},
+    {"id": 878, "name": "Science Fiction"},
+    {"id": 53, "name": "Thriller"},
+]
+
+# every n-th movie comes without a release date and gets skipped
+UNDATED_EVERY = 50
+# every n-th movie of the export has been removed since, its details
+# are not found
+MISSING_EVERY = 40
+
+
+def movie_title(movie_id: int) -> str:
+    return f"Synthetic movie {movie_id}"
+
+
+def movie_details(movie_id: int) -> dict:
+    rng = random.Random(movie_id)
+    return {
+        "id": movie_id,
+        "original_title": movie_title(movie_id),
+        "release_date": ""
+        if movie_id % UNDATED_EVERY == 0
+        else f"{rng.randint(1950, 2021)}-{rng.randint(1, 12):02}-"
+        f"{rng.randint(1, 28):02}",
+        "poster_path": f"poster_{movie_id}.jpg",
+        "overview": f"Overview of the synthetic movie {movie_id}. " * 4,
+        "genres": rng.sample(GENRES, rng.randint(1, 3)),
+    }
+
+
+def build_export(first_id: int, movies: int) -> bytes:
+    lines = (
+        json.dumps(
+            {
+                "adult": False,
+                "id": movie_id,
+                "original_title": movie_title(movie_id),
+                "popularity": 1.0,
+                "video": False,
+            }
+        )
+        for movie_id in range(first_id, first_id + movies)
+    )
+    return gzip.compress("\n".join(lines).encode("utf-8"))
+
+
+def create_app(
+    movies: int = 1000,
+    first_id: int = 1,
+    latency: float = 0,
+    error_rate: float = 0,
+    seed: Optional[int] = None,
+) -> web.Application:
+    rng = random.Random(seed)
+    export = build_export(first_id, movies)
+    app = web.Application()
+    app["stats"] = {"requests": 0, "errors": 0}
+
+    @web.middleware
+    async def misbehave(request, handler):
+        app["stats"]["requests"] += 1
+
+        if latency:
+            await asyncio.sleep(latency)
+
+        if rng.random() < error_rate:
+            app["stats"]["errors"] += 1
+            status = 429 if rng.random() < 0.5 else 503
+            return web.Response(status=status, headers={"Retry-After": "0"})
+
+        return await handler(request)
+
+    async def get_export(request):
+        return web.Response(
+            body=export, content_type="application/octet-stream"
+        )
+
+    async def get_movie(request):
+        movie_id = int(request.match_info["movie_id"])
+
+        if (
+            not first_id <= movie_id < first_id + movies
+            or movie_id % MISSING_EVERY == 0
+        ):
+            return web.json_response({"status_code": 34}, status=404)
+
+        return web.json_response(movie_details(movie_id))
+
+    async def get_genres(request):
+        return web.json_response({"genres": GENRES})
+
+    app.middlewares.append(misbehave)
+    app.router.add_get(r"/p/exports/{name}", get_export)
+    app.router.add_get(r"/3/movie/{movie_id:\d+}", get_movie)
+    app.router.add_get("/3/genre/movie/list", get_genres)
+    return app
+
+
+async def start_server(app: web.Application, port: int = 0) -> web.AppRunner:
+    """
+    Serves the app on localhost, the chosen port ends up in
+    `runner.addresses`
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def server_url(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
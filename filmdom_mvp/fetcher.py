@@ -0,0 +1,188 @@
+"""
+Building blocks of the TMDB fetching process: a token bucket pacing
+the requests, retries of throttled and failed requests and a pool of
+workers with a bounded number of requests in flight.
+"""
+
+from django.conf import settings
+from typing import AsyncIterable, Awaitable, Callable, Optional
+import aiohttp
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the resource does not exist, asking again gives the same answer
+MISSING_STATUSES = {404, 410}
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average,
+    with bursts of up to `capacity`
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchError(Exception):
+    """
+    A request which could not be completed. `permanent` errors fail
+    the same way when the request is repeated later.
+    """
+
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+def create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=settings.TMDB_CONCURRENCY,
+        limit_per_host=settings.TMDB_CONNECTIONS_PER_HOST,
+    )
+    timeout = aiohttp.ClientTimeout(total=settings.TMDB_REQUEST_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def retry_delay(attempt: int, response=None) -> float:
+    if response is not None and "Retry-After" in response.headers:
+        try:
+            return float(response.headers["Retry-After"])
+        except ValueError:
+            pass
+
+    # exponential backoff with jitter
+    return settings.TMDB_RETRY_BACKOFF * 2**attempt * random.uniform(0.5, 1)
+
+
+async def get_json(
+    session: aiohttp.ClientSession, url: str, bucket: TokenBucket
+) -> dict:
+    """
+    Paced GET of a json document. Throttled (429), failed (5xx)
+    and timed out requests are retried with a backoff.
+    """
+    return await get(session, url, bucket, lambda response: response.json())
+
+
+async def get_bytes(
+    session: aiohttp.ClientSession,
+    url: str,
+    bucket: TokenBucket,
+    max_size: int,
+) -> bytes:
+    """
+    Paced and retried GET of a file of at most `max_size` bytes
+    """
+
+    async def read(response: aiohttp.ClientResponse) -> bytes:
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            data += chunk
+            if len(data) > max_size:
+                raise FetchError(
+                    f"{url} is larger than {max_size} bytes", permanent=True
+                )
+
+        return bytes(data)
+
+    return await get(session, url, bucket, read)
+
+
+async def get(
+    session: aiohttp.ClientSession,
+    url: str,
+    bucket: TokenBucket,
+    read: Callable[[aiohttp.ClientResponse], Awaitable],
+):
+    for attempt in range(settings.TMDB_MAX_RETRIES + 1):
+        await bucket.acquire()
+        response = None
+
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return await read(response)
+
+                if response.status not in RETRY_STATUSES:
+                    raise FetchError(
+                        f"{url} returned {response.status}",
+                        permanent=response.status in MISSING_STATUSES,
+                    )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"Request to {url} failed: {e!r}")
+
+        if attempt < settings.TMDB_MAX_RETRIES:
+            await asyncio.sleep(retry_delay(attempt, response))
+
+    raise FetchError(f"{url} failed after {attempt + 1} attempts")
+
+
+async def run_bounded(
+    items: AsyncIterable,
+    worker: Callable[..., Awaitable],
+    concurrency: int,
+) -> dict:
+    """
+    Runs the worker for every item with at most `concurrency` of them
+    in flight. Items are pulled lazily and a failing item is only
+    logged, it never stops the others.
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"succeeded": 0, "failed": 0}
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+
+                await worker(item)
+                stats["succeeded"] += 1
+            except Exception:
+                stats["failed"] += 1
+                logger.exception(f"Processing of {item} failed")
+            finally:
+                queue.task_done()
+
+    consumers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+
+    try:
+        async for item in items:
+            await queue.put(item)
+
+        for _ in consumers:
+            await queue.put(None)
+
+        await asyncio.gather(*consumers)
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
+
+    return stats
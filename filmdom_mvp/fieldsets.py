@@ -0,0 +1,145 @@
+"""
+Sparse fieldsets: the `fields` and `exclude` query parameters pick the
+serialized fields (comma separated names), and the query loads only
+the columns and relations these fields need.
+
+A viewset can also set `list_fields`, a compact representation used
+by its list action when the request does not ask for fields;
+`representation=full` brings all the fields back.
+"""
+
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from typing import Dict, List, Optional, Set
+
+
+class SparseFieldsSerializerMixin:
+    """
+    Keeps only the fields listed in the `fields` context entry
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = self.context.get("fields")
+
+        if selected is not None:
+            for name in set(self.fields) - set(selected):
+                self.fields.pop(name)
+
+
+class SparseFieldsetMixin:
+    """
+    Viewset part of the sparse fieldsets. `trim_queryset` defers the
+    unneeded columns and sets up only the needed relations:
+
+    - `field_columns` maps serializer fields to the model paths they
+      read, plain model fields map to themselves
+    - `field_select_related` and `field_prefetch_related` map serializer
+      fields to the relation they follow
+    """
+
+    list_fields = None
+    field_columns: Dict[str, List[str]] = {}
+    field_select_related: Dict[str, str] = {}
+    field_prefetch_related: Dict[str, str] = {}
+
+    def get_field_names(self, param: str) -> Optional[List[str]]:
+        value = self.request.query_params.get(param)
+
+        if value is None:
+            return None
+
+        return [name.strip() for name in value.split(",") if name.strip()]
+
+    def selected_fields(self) -> Optional[Set[str]]:
+        """
+        Names of the serialized fields, None meaning all of them
+        """
+        if hasattr(self, "_selected_fields"):
+            return self._selected_fields
+
+        # writes always go through the whole serializer
+        if self.request.method not in SAFE_METHODS:
+            self._selected_fields = None
+            return None
+
+        available = set(self.get_serializer_class()().fields)
+        fields = self.get_field_names("fields")
+        exclude = self.get_field_names("exclude")
+        unknown = set(fields or ()).union(exclude or ()) - available
+
+        if unknown:
+            raise ValidationError(
+                f"Unknown fields: {', '.join(sorted(unknown))}"
+            )
+
+        if fields is not None:
+            selected = set(fields)
+        elif (
+            self.action == "list"
+            and self.list_fields is not None
+            and self.request.query_params.get("representation") != "full"
+        ):
+            selected = set(self.list_fields)
+        else:
+            selected = set(available)
+
+        if exclude is not None:
+            selected -= set(exclude)
+
+        self._selected_fields = None if selected == available else selected
+        return self._selected_fields
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["fields"] = self.selected_fields()
+        return context
+
+    def trim_queryset(self, queryset):
+        """
+        Loads the relations and columns of the selected fields only.
+        Has to be called on the ordered queryset, the ordering columns
+        stay loaded for the cursor of the next page.
+        """
+        selected = self.selected_fields()
+        all_fields = selected is None
+
+        if all_fields:
+            selected = set(self.get_serializer_class()().fields)
+
+        related = [
+            relation
+            for field, relation in self.field_select_related.items()
+            if field in selected
+        ]
+        prefetched = [
+            relation
+            for field, relation in self.field_prefetch_related.items()
+            if field in selected
+        ]
+        if related:
+            queryset = queryset.select_related(*related)
+        if prefetched:
+            queryset = queryset.prefetch_related(*prefetched)
+
+        if all_fields:
+            return queryset
+
+        concrete = {
+            field.name
+            for field in queryset.model._meta.concrete_fields
+        }
+        columns = {"pk"}
+
+        for field in selected:
+            for path in self.field_columns.get(field, [field]):
+                if path.split(LOOKUP_SEP)[0] in concrete:
+                    columns.add(path)
+
+        for name in queryset.query.order_by:
+            name = name.lstrip("-")
+            if name in concrete:
+                columns.add(name)
+
+        return queryset.only(*columns)
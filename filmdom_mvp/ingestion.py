@@ -0,0 +1,281 @@
+"""
+Database side of the TMDB import. Fetched movies are buffered and
+written in batches, so the import costs a few queries per batch
+instead of several per movie.
+
+Entries are identified by their TMDB ids. A run only fetches ids
+which are neither imported nor skipped yet, so an interrupted run
+continues right after the last saved batch.
+
+The new entries of a run are split into chunks fetched by separate
+Celery tasks (see tasks.py). The run counts the completed chunks
+and the last one finishes it.
+"""
+
+from asgiref.sync import sync_to_async
+from datetime import date
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from typing import List, Optional, Set, Tuple
+from . import search
+from .models import IngestionRun, Movie, MovieGenre, SkippedTmdbEntry
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def load_known_ids() -> Set[int]:
+    """
+    TMDB ids which do not need to be fetched again:
+    imported movies and the skipped entries
+    """
+    known = set(
+        Movie.objects.filter(tmdb_id__isnull=False).values_list(
+            "tmdb_id", flat=True
+        )
+    )
+    known.update(SkippedTmdbEntry.objects.values_list("tmdb_id", flat=True))
+    return known
+
+
+def load_genre_ids() -> Set[int]:
+    return set(MovieGenre.objects.values_list("id", flat=True))
+
+
+def sync_genres(genres: List[dict]) -> dict:
+    """
+    Brings MovieGenre in line with the TMDB genre list in one pass.
+    New genres are inserted and renamed ones updated in place, so their
+    movie links survive. Only local genres holding the name of a TMDB
+    genre under another id are deleted, their links are moved over to
+    the TMDB genre first.
+    """
+    remote = {g["id"]: g["name"] for g in genres}
+    remote_ids = {name: id for id, name in remote.items()}
+
+    with transaction.atomic():
+        local = dict(MovieGenre.objects.values_list("id", "name"))
+        orphans = {
+            id: remote_ids[name]
+            for id, name in local.items()
+            if id not in remote
+            and name in remote_ids
+            and remote_ids[name] != id
+        }
+        renamed = [
+            MovieGenre(id=id, name=name)
+            for id, name in remote.items()
+            if id in local and local[id] != name
+        ]
+        created = [
+            MovieGenre(id=id, name=name)
+            for id, name in remote.items()
+            if id not in local
+        ]
+        Link = Movie.genres.through
+        links = [
+            Link(movie_id=movie_id, moviegenre_id=orphans[genre_id])
+            for movie_id, genre_id in Link.objects.filter(
+                moviegenre_id__in=orphans
+            ).values_list("movie_id", "moviegenre_id")
+        ]
+
+        # orphans go first, they hold the names taken over below
+        if orphans:
+            MovieGenre.objects.filter(id__in=orphans).delete()
+
+        # genres swapping names would collide in a single update
+        held = set(local.values())
+        swapped = [
+            MovieGenre(id=genre.id, name=f"{genre.name} ({genre.id})")
+            for genre in renamed
+            if genre.name in held
+        ]
+        MovieGenre.objects.bulk_update(swapped, ["name"])
+        MovieGenre.objects.bulk_update(renamed, ["name"])
+        MovieGenre.objects.bulk_create(created)
+        Link.objects.bulk_create(links, ignore_conflicts=True)
+
+    return {
+        "created": len(created),
+        "renamed": len(renamed),
+        "deleted": len(orphans),
+    }
+
+
+def start_run(export_date: date, requested: int = 0) -> IngestionRun:
+    run, created = IngestionRun.objects.get_or_create(export_date=export_date)
+
+    if not created:
+        logger.info(f"Resuming the import of the {export_date} export")
+
+    IngestionRun.objects.filter(pk=run.pk).update(
+        requested=F("requested") + requested, finished=None
+    )
+    return run
+
+
+def add_chunks(run_id: int, chunks: int) -> bool:
+    """
+    Counts new chunks of the run, the chunks of an earlier dispatch
+    may still be running. Returns True when none is left to complete.
+    """
+    with transaction.atomic():
+        run = IngestionRun.objects.select_for_update().get(pk=run_id)
+        run.chunks += chunks
+        run.save(update_fields=["chunks", "updated"])
+
+    return run.completed_chunks >= run.chunks
+
+
+def record_chunk(run_id: int, failed: int) -> bool:
+    """
+    Marks one chunk of the run as completed.
+    Returns True for the last one.
+    """
+    with transaction.atomic():
+        # chunks finish concurrently, the row lock serializes the count
+        run = IngestionRun.objects.select_for_update().get(pk=run_id)
+        run.completed_chunks += 1
+        run.failed += failed
+        run.save(update_fields=["completed_chunks", "failed", "updated"])
+
+    return run.completed_chunks >= run.chunks
+
+
+def finish_run(run_id: int) -> IngestionRun:
+    IngestionRun.objects.filter(pk=run_id).update(finished=timezone.now())
+    return IngestionRun.objects.get(pk=run_id)
+
+
+def write_movies(
+    batch: List[Tuple[Movie, List[int]]],
+    skipped: List[Tuple[int, str]],
+    run_id: Optional[int] = None,
+) -> int:
+    """
+    Inserts the movies with their genre links and records the skipped
+    entries. Movies whose title is taken by another TMDB entry are
+    skipped as well, movies imported before TMDB ids were stored just
+    get their id. Returns the number of movies written.
+    """
+    skipped = list(skipped)
+
+    with transaction.atomic():
+        taken = dict(
+            Movie.objects.filter(
+                title__in=[movie.title for movie, _ in batch]
+            ).values_list("title", "tmdb_id")
+        )
+        adopted = {}
+        new_batch = []
+
+        for movie, genre_ids in batch:
+            if movie.title not in taken:
+                taken[movie.title] = movie.tmdb_id
+                new_batch.append((movie, genre_ids))
+            elif taken[movie.title] is None:
+                adopted[movie.title] = movie.tmdb_id
+                taken[movie.title] = movie.tmdb_id
+            else:
+                skipped.append((movie.tmdb_id, "duplicate title"))
+
+        batch = new_batch
+        movies = [movie for movie, _ in batch]
+
+        # conflicts can still come from a concurrent import
+        Movie.objects.bulk_create(movies, ignore_conflicts=True)
+
+        # ignore_conflicts does not give the primary keys back
+        ids = dict(
+            Movie.objects.filter(
+                tmdb_id__in=[movie.tmdb_id for movie in movies]
+            ).values_list("tmdb_id", "id")
+        )
+        for movie in movies:
+            movie.pk = ids.get(movie.tmdb_id)
+        written = [movie for movie in movies if movie.pk is not None]
+
+        Movie.genres.through.objects.bulk_create(
+            [
+                Movie.genres.through(movie_id=movie.pk, moviegenre_id=genre)
+                for movie, genre_ids in batch
+                if movie.pk is not None
+                for genre in genre_ids
+            ],
+            ignore_conflicts=True,
+        )
+        search.index_titles(written)
+
+        if adopted:
+            legacy = list(
+                Movie.objects.filter(
+                    title__in=adopted, tmdb_id__isnull=True
+                ).only("id", "title")
+            )
+            for movie in legacy:
+                movie.tmdb_id = adopted[movie.title]
+            Movie.objects.bulk_update(legacy, ["tmdb_id"])
+
+        SkippedTmdbEntry.objects.bulk_create(
+            [
+                SkippedTmdbEntry(tmdb_id=tmdb_id, reason=reason)
+                for tmdb_id, reason in skipped
+            ],
+            ignore_conflicts=True,
+        )
+
+        if run_id is not None:
+            IngestionRun.objects.filter(pk=run_id).update(
+                saved=F("saved") + len(written),
+                skipped=F("skipped") + len(skipped),
+                updated=timezone.now(),
+            )
+
+    return len(written)
+
+
+class MovieWriter:
+    """
+    Collects movies built by the fetching workers
+    and writes them `batch_size` at a time
+    """
+
+    def __init__(
+        self, batch_size: int, genre_ids: Set[int], run_id: Optional[int]
+    ):
+        self.batch_size = batch_size
+        self.genre_ids = genre_ids
+        self.run_id = run_id
+        self.buffer = []
+        self.skipped = []
+        self.written = 0
+        self.lock = asyncio.Lock()
+
+    async def add(self, movie: Movie, genre_ids: List[int]):
+        self.buffer.append(
+            (movie, [g for g in genre_ids if g in self.genre_ids])
+        )
+
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    def skip(self, tmdb_id: int, reason: str):
+        self.skipped.append((tmdb_id, reason))
+
+    async def flush(self):
+        # batches are written one at a time, workers keep
+        # filling the next buffer in the meantime
+        async with self.lock:
+            batch, self.buffer = self.buffer, []
+            skipped, self.skipped = self.skipped, []
+
+            if not batch and not skipped:
+                return
+
+            self.written += await sync_to_async(write_movies)(
+                batch, skipped, self.run_id
+            )
+            logger.info(f"Saved a batch of {len(batch)} movies")
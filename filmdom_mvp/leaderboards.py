@@ -0,0 +1,255 @@
+"""
+Leaderboards: materialized rankings of the sort methods the homepage
+asks for the most. MovieViewSet serves these sorts from the board
+instead of ordering the whole movies table, and tells how old the
+ranking is in the X-Leaderboard-Refreshed-At header.
+
+A board is rebuilt by the `refresh_leaderboards` task when it is
+dirty, only the entries whose rank changed are rewritten. Comment
+writes dirty the rating boards, movie changes and imports all of them.
+Until its first refresh a board is not used and the sort is computed
+live.
+
+Every process reloads the refresh times of the boards from the
+database once per LEADERBOARD_STATE_TTL seconds, so picking the board
+usually costs no query. Cursors over a board are tagged with its
+refresh time and stop working when it is rebuilt, the ranks they
+point to have moved.
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, FloatField, IntegerField, Value, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from . import cache as response_cache
+from .models import BEST_RATING_KEY, Leaderboard, LeaderboardEntry, Movie
+import threading
+import time
+
+REFRESHED_AT_HEADER = "X-Leaderboard-Refreshed-At"
+
+# (score, ordering) of every board, the orderings are the ones
+# MovieViewSet uses for the same sort methods
+BOARDS = {
+    "best": (BEST_RATING_KEY, [BEST_RATING_KEY.desc(), F("id").desc()]),
+    "most_popular": (
+        F("rating_count"),
+        [F("rating_count").desc(), F("id").desc()],
+    ),
+    "newest": (None, [F("produce_date").desc(), F("id").desc()]),
+}
+RATING_BOARDS = ("best", "most_popular")
+
+# above this share of changed entries a board is copied anew
+# instead of updated entry by entry
+FULL_REBUILD_SHARE = 0.5
+
+
+def mark_dirty(*names: str):
+    # dirty boards are left alone, every comment write would
+    # otherwise queue up on the same few rows
+    Leaderboard.objects.filter(
+        name__in=names or list(BOARDS), dirty=False
+    ).update(dirty=True)
+
+
+def refresh(names: Iterable[str] = None, force: bool = False) -> List[str]:
+    """
+    Rebuilds the dirty boards (all the given ones with `force`),
+    returns the names of the rebuilt ones
+    """
+    refreshed = []
+
+    for name in names or BOARDS:
+        board, created = Leaderboard.objects.get_or_create(name=name)
+
+        # cleared first, a write during the rebuild dirties it again
+        cleared = Leaderboard.objects.filter(pk=board.pk, dirty=True).update(
+            dirty=False
+        )
+        if not (cleared or created or force):
+            continue
+
+        try:
+            rebuild(board)
+        except Exception:
+            mark_dirty(name)
+            raise
+
+        refreshed.append(name)
+
+    if refreshed:
+        response_cache.bump_versions("leaderboards")
+        transaction.on_commit(board_states.clear)
+
+    return refreshed
+
+
+def rebuild(board: Leaderboard):
+    """
+    Brings the entries of the board in line with the current ranking.
+    The database computes the ranking and compares it with the stored
+    one, only the movies whose rank or score changed come back and are
+    written. A rating moving a movie k places costs one pass over the
+    movies plus about k updated entries. When most of the board moved,
+    e.g. a new movie on top of "newest" shifts every rank, the entries
+    are replaced with one INSERT ... SELECT instead.
+    """
+    score, ordering = BOARDS[board.name]
+    ranked = Movie.objects.annotate(
+        board_id=Value(board.pk, output_field=IntegerField()),
+        movie_ref=F("id"),
+        board_score=Value(None, output_field=FloatField())
+        if score is None
+        else score,
+        board_rank=Window(RowNumber(), order_by=ordering),
+    ).values_list("board_id", "movie_ref", "board_score", "board_rank")
+    select, params = ranked.query.sql_with_params()
+
+    meta = LeaderboardEntry._meta
+    table = connection.ops.quote_name(meta.db_table)
+    column = {
+        name: connection.ops.quote_name(meta.get_field(name).column)
+        for name in ("id", "leaderboard", "movie", "score", "rank")
+    }
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT r.movie_ref, r.board_score, r.board_rank, "
+                f"e.{column['id']} FROM ({select}) r "
+                f"LEFT JOIN {table} e ON e.{column['movie']} = r.movie_ref "
+                f"AND e.{column['leaderboard']} = %s "
+                f"WHERE e.{column['id']} IS NULL "
+                f"OR e.{column['rank']} <> r.board_rank "
+                f"OR NOT (e.{column['score']} = r.board_score "
+                f"OR (e.{column['score']} IS NULL "
+                f"AND r.board_score IS NULL))",
+                (*params, board.pk),
+            )
+            changed = cursor.fetchall()
+
+        entries = LeaderboardEntry.objects.filter(leaderboard=board)
+        if len(changed) > FULL_REBUILD_SHARE * entries.count():
+            entries.delete()
+            columns = ", ".join(
+                column[name] for name in ("leaderboard", "movie", "score")
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {table} ({columns}, {column['rank']}) "
+                    f"{select}",
+                    params,
+                )
+        else:
+            updated = [
+                LeaderboardEntry(
+                    id=entry_id,
+                    leaderboard=board,
+                    movie_id=movie_id,
+                    score=movie_score,
+                    rank=rank,
+                )
+                for movie_id, movie_score, rank, entry_id in changed
+            ]
+            LeaderboardEntry.objects.bulk_update(
+                [entry for entry in updated if entry.id is not None],
+                ["score", "rank"],
+                batch_size=500,
+            )
+            LeaderboardEntry.objects.bulk_create(
+                [entry for entry in updated if entry.id is None],
+                batch_size=500,
+            )
+
+        board.refreshed_at = timezone.now()
+        board.save(update_fields=["refreshed_at"])
+
+
+class BoardStates:
+    """
+    Process wide copy of the ids and refresh times of the ready
+    boards, reloaded every LEADERBOARD_STATE_TTL seconds
+    """
+
+    def __init__(self):
+        self.states: Dict[str, Tuple[int, str]] = {}
+        self.expires = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[Tuple[int, str]]:
+        now = time.monotonic()
+
+        with self.lock:
+            if self.expires > now:
+                return self.states.get(name)
+
+        states = {
+            name: (pk, refreshed_at.isoformat())
+            for name, pk, refreshed_at in Leaderboard.objects.filter(
+                refreshed_at__isnull=False
+            ).values_list("name", "pk", "refreshed_at")
+        }
+
+        with self.lock:
+            self.states = states
+            self.expires = now + settings.LEADERBOARD_STATE_TTL
+
+        return states.get(name)
+
+    def clear(self):
+        with self.lock:
+            self.states = {}
+            self.expires = 0.0
+
+
+board_states = BoardStates()
+
+
+def ready_board(name: Optional[str]) -> Optional[Tuple[int, str]]:
+    """
+    Id and refresh time of the board of a sort method, None when
+    the sort method has no board ready
+    """
+    if name not in BOARDS:
+        return None
+
+    return board_states.get(name)
+
+
+def ranked_movies(board_id: int):
+    return (
+        Movie.objects.filter(leaderboard_entries__leaderboard_id=board_id)
+        .annotate(leaderboard_rank=F("leaderboard_entries__rank"))
+        .order_by("leaderboard_rank")
+    )
+
+
+class LeaderboardMixin:
+    """
+    Serves the sort methods with a ready board from it. The viewset
+    calls `leaderboard_queryset` and the list response gets the
+    refresh time of the board it came from.
+    """
+
+    def leaderboard_queryset(self, sort_method: Optional[str]):
+        board = ready_board(sort_method)
+
+        if board is None:
+            return None
+
+        board_id, self.leaderboard_refreshed_at = board
+        self.cursor_tag = f"{board_id}:{self.leaderboard_refreshed_at}"
+        return ranked_movies(board_id)
+
+    def list(self, request, *args, **kwargs):
+        self.leaderboard_refreshed_at = None
+        self.cursor_tag = None
+        response = super().list(request, *args, **kwargs)
+
+        if self.leaderboard_refreshed_at is not None:
+            response[REFRESHED_AT_HEADER] = self.leaderboard_refreshed_at
+
+        return response
@@ -0,0 +1,289 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from filmdom_mvp import profiling
+from filmdom_mvp.models import Movie
+from rest_framework.test import APIClient
+from typing import List
+from urllib.parse import parse_qs, urlparse
+import json
+import statistics
+import time
+
+MOVIE_SORTS = [
+    None,
+    "best",
+    "worst",
+    "most_popular",
+    "least_popular",
+    "newest",
+    "oldest",
+    "random",
+]
+
+
+class Case:
+    def __init__(self, name: str, path: str, params: dict = None, depth=0):
+        self.name = name
+        self.path = path
+        self.params = params or {}
+        # cursor pages walked before the measured request
+        self.depth = depth
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures p50/p95 latency, query count and fetched rows of every "
+        "documented list parameter. Writes a JSON report and compares it "
+        "with a baseline report, failing on regressions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--output", default="api_benchmark.json")
+        parser.add_argument("--baseline")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.25,
+            help="allowed relative slowdown of p95 and growth of rows",
+        )
+        parser.add_argument(
+            "--catalog-movies",
+            type=int,
+            default=20_000,
+            help="movies the database has to hold",
+        )
+        parser.add_argument("--catalog-comments", type=int, default=200_000)
+        parser.add_argument(
+            "--generate-catalog",
+            action="store_true",
+            help="generate the catalog when the database holds fewer "
+            "movies, it adds to the data already there",
+        )
+        parser.add_argument(
+            "--cache",
+            action="store_true",
+            help="keep the response cache on, it is off by default",
+        )
+
+    def handle(self, *args, **options):
+        movies = Movie.objects.count()
+
+        if movies < options["catalog_movies"]:
+            if not options["generate_catalog"]:
+                raise CommandError(
+                    f"The database holds {movies} movies, "
+                    f"{options['catalog_movies']} are needed. Run with "
+                    f"--generate-catalog to generate them or lower "
+                    f"--catalog-movies."
+                )
+
+            call_command(
+                "generate_catalog",
+                movies=options["catalog_movies"],
+                comments=options["catalog_comments"],
+                stdout=self.stdout,
+            )
+
+        # e.g. catalogs generated before the dimensions were stored
+        if Movie.objects.filter(image_width__isnull=True).exists():
+            self.stdout.write(
+                self.style.WARNING(
+                    "Some movies have no stored thumbnail dimensions, "
+                    "loading them opens the image file. Their list "
+                    "timings measure that file I/O."
+                )
+            )
+
+        self.client = APIClient(HTTP_HOST="localhost")
+        overrides = {} if options["cache"] else {"CATALOG_CACHE_TIMEOUT": 0}
+
+        with override_settings(**overrides):
+            report = {
+                case.name: self.measure(case, options["repeat"])
+                for case in self.cases()
+            }
+
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        for name, result in report.items():
+            self.stdout.write(
+                f"{name:<45} p50 {result['p50_ms']:>8.2f}ms  "
+                f"p95 {result['p95_ms']:>8.2f}ms  "
+                f"queries {result['queries']:>3}  rows {result['rows']:>6}"
+            )
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+            regressions = self.compare(
+                report, baseline, options["tolerance"]
+            )
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+
+            if regressions:
+                raise CommandError(
+                    f"{len(regressions)} regressions against the baseline"
+                )
+
+            self.stdout.write(self.style.SUCCESS("No regressions"))
+
+    def cases(self) -> List[Case]:
+        movie = Movie.objects.order_by("-rating_count").first()
+        user = (
+            User.objects.filter(comment__isnull=False)
+            .order_by("id")
+            .first()
+        )
+        title = movie.title if movie is not None else "movie"
+        # a word shared by many titles and a selective fragment
+        common = title.split()[0]
+        cases = []
+
+        for sort in MOVIE_SORTS:
+            for limit in (None, 10, 100):
+                params = {}
+                if sort is not None:
+                    params["sort_method"] = sort
+                if limit is not None:
+                    params["limit"] = limit
+                if sort == "random":
+                    params["seed"] = 1
+                name = f"movies {sort or 'title'} limit={limit}"
+                cases.append(Case(name, "/movies/", params))
+
+        cases += [
+            Case(
+                "movies title_like common", "/movies/", {"title_like": common}
+            ),
+            Case("movies title_like exact", "/movies/", {"title_like": title}),
+            Case(
+                "movies title_like relevance",
+                "/movies/",
+                {"title_like": common, "sort_method": "relevance"},
+            ),
+            Case(
+                "movies full limit=100",
+                "/movies/",
+                {"representation": "full", "limit": 100},
+            ),
+            Case(
+                "movies fields=id,title limit=100",
+                "/movies/",
+                {"fields": "id,title", "limit": 100},
+            ),
+            Case("movies page=2", "/movies/", {"page": 2}),
+            Case("movies page=50", "/movies/", {"page": 50}),
+            Case(
+                "movies cursor depth=10",
+                "/movies/",
+                {"pagination": "cursor", "sort_method": "best"},
+                depth=10,
+            ),
+            Case("comments", "/comments/"),
+            Case("comments newest", "/comments/", {"sort_method": "newest"}),
+            Case("comments limit=100", "/comments/", {"limit": 100}),
+            Case("comments page=50", "/comments/", {"page": 50}),
+            Case(
+                "comments cursor depth=10",
+                "/comments/",
+                {"pagination": "cursor", "sort_method": "newest"},
+                depth=10,
+            ),
+            Case("comments title_like", "/comments/", {"title_like": common}),
+            Case("directors", "/directors/"),
+            Case("actors", "/actors/"),
+            Case("genres", "/genres/"),
+        ]
+
+        if movie is not None:
+            cases += [
+                Case("movie detail", f"/movies/{movie.id}/"),
+                Case(
+                    "comments movie_id", "/comments/", {"movie_id": movie.id}
+                ),
+                Case("comments title", "/comments/", {"title": movie.title}),
+            ]
+
+        if user is not None:
+            cases += [
+                Case("comments user", "/comments/", {"user": user.username}),
+                Case("comments user_id", "/comments/", {"user_id": user.id}),
+            ]
+
+        return cases
+
+    def walk_cursor(self, case: Case) -> dict:
+        params = dict(case.params)
+
+        for _ in range(case.depth):
+            next_link = self.client.get(case.path, params).json()["next"]
+            if next_link is None:
+                break
+            params = {**params, "cursor": self.cursor_of(next_link)}
+
+        return params
+
+    @staticmethod
+    def cursor_of(link: str) -> str:
+        return parse_qs(urlparse(link).query)["cursor"][0]
+
+    def measure(self, case: Case, repeat: int) -> dict:
+        params = self.walk_cursor(case) if case.depth else case.params
+        timings = []
+
+        # the first request warms the caches of the database
+        self.client.get(case.path, params)
+
+        for _ in range(repeat):
+            with profiling.count_queries() as stats:
+                start = time.perf_counter()
+                response = self.client.get(case.path, params)
+                timings.append((time.perf_counter() - start) * 1000)
+
+        return {
+            "path": case.path,
+            "params": {key: str(value) for key, value in params.items()},
+            "status": response.status_code,
+            "p50_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(percentile(timings, 0.95), 3),
+            "queries": stats.queries,
+            "rows": stats.rows,
+        }
+
+    @staticmethod
+    def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+        regressions = []
+
+        for name, base in baseline.items():
+            result = report.get(name)
+            if result is None:
+                continue
+
+            if result["queries"] > base["queries"]:
+                regressions.append(
+                    f"{name}: {result['queries']} queries, "
+                    f"baseline {base['queries']}"
+                )
+            if result["rows"] > base["rows"] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {result['rows']} rows fetched, "
+                    f"baseline {base['rows']}"
+                )
+            if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: p95 {result['p95_ms']}ms, "
+                    f"baseline {base['p95_ms']}ms"
+                )
+
+        return regressions
@@ -0,0 +1,226 @@
+from asgiref.testing import ApplicationCommunicator
+from concurrent.futures import ThreadPoolExecutor
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test.utils import override_settings
+from filmdom_mvp.management.commands.benchmark_api import percentile
+from io import BytesIO
+from typing import Awaitable, Callable, List
+import aiohttp
+import asyncio
+import json
+import statistics
+import time
+
+DEFAULT_PATHS = [
+    "/movies/?sort_method=best",
+    "/movies/?sort_method=newest&limit=50",
+    "/comments/?sort_method=newest",
+    "/genres/",
+]
+
+
+def split_path(path: str):
+    path, _, query = path.partition("?")
+    return path, query
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares requests/sec of the sync API under WSGI with the async "
+        "read endpoints (/async/...) under ASGI at the same concurrency. "
+        "Without --wsgi-url/--asgi-url both applications are driven in "
+        "process: WSGI by a pool of `--concurrency` threads like a "
+        "threaded server, ASGI by one event loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument(
+            "--path",
+            action="append",
+            dest="paths",
+            help="sync API path with query, can be repeated",
+        )
+        parser.add_argument("--asgi-prefix", default="/async")
+        parser.add_argument(
+            "--wsgi-url", help="e.g. a gunicorn filmdom.wsgi deployment"
+        )
+        parser.add_argument(
+            "--asgi-url",
+            help="e.g. an uvicorn filmdom.asgi:application deployment",
+        )
+        parser.add_argument("--output")
+        parser.add_argument(
+            "--cache",
+            action="store_true",
+            help="keep the response cache on, it is off by default "
+            "(in process only, deployments keep their settings)",
+        )
+
+    def handle(self, *args, **options):
+        self.total = options["requests"]
+        self.concurrency = options["concurrency"]
+        paths = options["paths"] or DEFAULT_PATHS
+        async_paths = [options["asgi_prefix"] + path for path in paths]
+
+        # the async endpoints run the same cached viewsets, without the
+        # cache every run measures the full work of the views
+        overrides = {} if options["cache"] else {"CATALOG_CACHE_TIMEOUT": 0}
+
+        with override_settings(**overrides):
+            report = {
+                "wsgi": asyncio.run(
+                    self.run_wsgi(paths, options["wsgi_url"])
+                ),
+                # the sync viewsets under ASGI, the case the async
+                # endpoints are meant to improve on
+                "asgi_sync_views": asyncio.run(
+                    self.run_asgi(paths, options["asgi_url"])
+                ),
+                "asgi": asyncio.run(
+                    self.run_asgi(async_paths, options["asgi_url"])
+                ),
+            }
+
+        for name, result in report.items():
+            self.stdout.write(
+                f"{name}: {result['requests_per_second']:.1f} req/s, "
+                f"p50 {result['p50_ms']:.1f}ms, p95 {result['p95_ms']:.1f}ms, "
+                f"errors {result['errors']}"
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+
+    async def run_wsgi(self, paths: List[str], url: str = None) -> dict:
+        if url is not None:
+            return await self.run_http(url, paths)
+
+        app = get_wsgi_application()
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        loop = asyncio.get_running_loop()
+
+        def call(path: str) -> int:
+            path, query = split_path(path)
+            environ = {
+                "REQUEST_METHOD": "GET",
+                "PATH_INFO": path,
+                "QUERY_STRING": query,
+                "SERVER_NAME": "localhost",
+                "SERVER_PORT": "80",
+                "HTTP_HOST": "localhost",
+                "wsgi.url_scheme": "http",
+                "wsgi.input": BytesIO(),
+                "wsgi.errors": BytesIO(),
+            }
+            statuses = []
+            body = app(
+                environ, lambda status, headers: statuses.append(status)
+            )
+            try:
+                b"".join(body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+
+            return int(statuses[0].split()[0])
+
+        async def request(path: str) -> int:
+            return await loop.run_in_executor(pool, call, path)
+
+        try:
+            return await self.run_load(request, paths)
+        finally:
+            pool.shutdown()
+
+    async def run_asgi(self, paths: List[str], url: str = None) -> dict:
+        if url is not None:
+            return await self.run_http(url, paths)
+
+        app = get_asgi_application()
+
+        async def request(path: str) -> int:
+            path, query = split_path(path)
+            communicator = ApplicationCommunicator(
+                app,
+                {
+                    "type": "http",
+                    "asgi": {"version": "3.0"},
+                    "http_version": "1.1",
+                    "method": "GET",
+                    "scheme": "http",
+                    "path": path,
+                    "raw_path": path.encode(),
+                    "query_string": query.encode(),
+                    "root_path": "",
+                    "headers": [(b"host", b"localhost")],
+                    "client": ("127.0.0.1", 0),
+                    "server": ("localhost", 80),
+                },
+            )
+            await communicator.send_input(
+                {"type": "http.request", "body": b"", "more_body": False}
+            )
+            start = await communicator.receive_output(timeout=60)
+
+            while True:
+                message = await communicator.receive_output(timeout=60)
+                if not message.get("more_body"):
+                    break
+
+            await communicator.wait()
+            return start["status"]
+
+        return await self.run_load(request, paths)
+
+    async def run_http(self, url: str, paths: List[str]) -> dict:
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+
+            async def request(path: str) -> int:
+                async with session.get(url.rstrip("/") + path) as response:
+                    await response.read()
+                    return response.status
+
+            return await self.run_load(request, paths)
+
+    async def run_load(
+        self, request: Callable[[str], Awaitable[int]], paths: List[str]
+    ) -> dict:
+        """
+        Sends `self.total` requests cycling over the paths,
+        `self.concurrency` of them in flight
+        """
+        timings = []
+        errors = 0
+        next_request = iter(range(self.total))
+
+        async def client():
+            nonlocal errors
+            for i in next_request:
+                start = time.perf_counter()
+                try:
+                    status = await request(paths[i % len(paths)])
+                except Exception:
+                    status = None
+                timings.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(self.concurrency)))
+        elapsed = time.perf_counter() - start
+
+        return {
+            "requests": self.total,
+            "concurrency": self.concurrency,
+            "requests_per_second": round(self.total / elapsed, 2),
+            "p50_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(percentile(timings, 0.95), 3),
+            "errors": errors,
+        }
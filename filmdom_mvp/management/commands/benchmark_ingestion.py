@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models import Max
+from django.test.utils import override_settings
+from filmdom_mvp import fake_tmdb, tasks
+from filmdom_mvp.models import Movie, SkippedTmdbEntry
+import asyncio
+import os
+import resource
+import time
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a full start_data_fetch against a local fake TMDB server "
+        "and reports the throughput. The movies are written to the "
+        "configured database, use a scratch one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--movies", type=int, default=1000)
+        parser.add_argument(
+            "--latency", type=float, default=0.02, help="seconds"
+        )
+        parser.add_argument("--error-rate", type=float, default=0.01)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--requests-per-second",
+            type=float,
+            help="defaults to TMDB_REQUESTS_PER_SECOND",
+        )
+
+    def handle(self, *args, **options):
+        # the export ids continue after the already known ones,
+        # so repeated runs always import new movies
+        first_id = 1 + max(
+            Movie.objects.aggregate(id=Max("tmdb_id"))["id"] or 0,
+            SkippedTmdbEntry.objects.aggregate(id=Max("tmdb_id"))["id"] or 0,
+        )
+        app = fake_tmdb.create_app(
+            movies=options["movies"],
+            first_id=first_id,
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            seed=options["seed"],
+        )
+        os.environ.setdefault("TMDB_API_KEY", "fake")
+
+        # the ORM runs in the sync_to_async threads,
+        # their connections are created during the run
+        counter = QueryCounter()
+
+        def count_queries(connection, **kwargs):
+            connection.execute_wrappers.append(counter)
+
+        connection_created.connect(count_queries)
+        for connection in connections.all():
+            connection.execute_wrappers.append(counter)
+
+        movies_before = Movie.objects.count()
+        start = time.perf_counter()
+        try:
+            asyncio.run(
+                self.run(
+                    app,
+                    options["movies"],
+                    options["requests_per_second"]
+                    or settings.TMDB_REQUESTS_PER_SECOND,
+                )
+            )
+        finally:
+            connection_created.disconnect(count_queries)
+            for connection in connections.all():
+                if counter in connection.execute_wrappers:
+                    connection.execute_wrappers.remove(counter)
+
+        elapsed = time.perf_counter() - start
+        saved = Movie.objects.count() - movies_before
+        # kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        self.stdout.write(
+            f"export entries: {options['movies']}\n"
+            f"saved movies: {saved}\n"
+            f"fake TMDB requests: {app['stats']['requests']} "
+            f"(errors: {app['stats']['errors']})\n"
+            f"elapsed: {elapsed:.2f}s\n"
+            f"movies/sec: {saved / elapsed:.1f}\n"
+            f"db queries: {counter.count}\n"
+            f"peak RSS: {peak_rss:.1f} MiB"
+        )
+
+    async def run(self, app, movies: int, rate: float):
+        runner = await fake_tmdb.start_server(app)
+        url = fake_tmdb.server_url(runner)
+
+        try:
+            with override_settings(
+                TMDB_API_URL=f"{url}/3",
+                TMDB_EXPORT_URL=f"{url}/p/exports",
+                TMDB_MAX_MOVIES_PER_RUN=movies,
+                TMDB_REQUESTS_PER_SECOND=rate,
+            ):
+                await tasks.start_data_fetch()
+        finally:
+            await runner.cleanup()
@@ -0,0 +1,375 @@
+from datetime import date, timedelta
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.images import get_image_dimensions
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from filmdom_mvp import cache, leaderboards, search
+from filmdom_mvp.models import (
+    RATING_BUCKETS,
+    Actor,
+    Comment,
+    Director,
+    Movie,
+    MovieGenre,
+    MovieTitleGram,
+    rating_bucket_field,
+)
+from itertools import accumulate
+from typing import Iterator, List
+import random
+import time
+
+# the catalog is dated relative to a day picked by the seed, so a seed
+# always generates the same rows
+FIRST_CATALOG_DAY = date(2021, 1, 1)
+
+GENRES = [
+    "action",
+    "adventure",
+    "animation",
+    "comedy",
+    "crime",
+    "documentary",
+    "drama",
+    "fantasy",
+    "horror",
+    "romance",
+    "science fiction",
+    "thriller",
+]
+
+WORDS = [
+    "dark",
+    "silent",
+    "last",
+    "red",
+    "lost",
+    "golden",
+    "broken",
+    "wild",
+    "night",
+    "river",
+    "empire",
+    "city",
+    "storm",
+    "garden",
+    "shadow",
+    "king",
+]
+
+PHRASES = [
+    "loved it",
+    "not my cup of tea",
+    "great acting",
+    "too long",
+    "would watch again",
+    "boring second half",
+    None,
+    None,
+]
+
+
+class PowerLaw:
+    """
+    Picks ids with a Zipf like skew: the id of rank r is drawn with
+    weight 1 / r**exponent. Ranks are shuffled, so popularity does not
+    follow the id order.
+    """
+
+    def __init__(self, rng: random.Random, ids: List[int], exponent: float):
+        self.rng = rng
+        self.ids = list(ids)
+        rng.shuffle(self.ids)
+        self.cum_weights = list(
+            accumulate(1 / rank**exponent for rank in range(1, len(ids) + 1))
+        )
+
+    def sample(self, k: int) -> List[int]:
+        return self.rng.choices(self.ids, cum_weights=self.cum_weights, k=k)
+
+
+def next_id(model) -> int:
+    return (model.objects.aggregate(id=Max("id"))["id"] or 0) + 1
+
+
+def batches(total: int, size: int) -> Iterator[range]:
+    for start in range(0, total, size):
+        yield range(start, min(start + size, total))
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the database with a seeded synthetic catalog for load "
+        "testing. Popular movies get most of the comments and user "
+        "activity follows a power law. Movies, their links and comments "
+        "are inserted as plain rows, so signals do not run and the "
+        "derived data is rebuilt at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--movies", type=int, default=10_000)
+        parser.add_argument("--actors", type=int, default=1000)
+        parser.add_argument("--directors", type=int, default=200)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--comments", type=int, default=100_000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--skew", type=float, default=1.1)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.today = FIRST_CATALOG_DAY + timedelta(
+            days=self.rng.randrange(365)
+        )
+        self.batch_size = options["batch_size"]
+        self.skew = options["skew"]
+        # generated users can not log in, hashing is done once
+        self.password = make_password(None)
+        start = time.perf_counter()
+
+        genre_ids = self.create_genres()
+        user_ids = self.create_rows(
+            User,
+            options["users"],
+            lambda id: User(
+                id=id, username=f"user{id}", password=self.password
+            ),
+        )
+        director_ids = self.create_rows(
+            Director,
+            options["directors"],
+            lambda id: Director(id=id, name=f"director {id}"),
+        )
+        actor_ids = self.create_rows(
+            Actor,
+            options["actors"],
+            lambda id: Actor(id=id, name=f"actor {id}"),
+        )
+        movie_ids = self.create_movies(
+            options["movies"], genre_ids, director_ids, actor_ids
+        )
+        self.create_comments(options["comments"], movie_ids, user_ids)
+        self.reset_sequences()
+
+        # the rows were inserted without signals
+        self.stdout.write("Rebuilding the ratings")
+        Movie.rebuild_ratings()
+        search.create_trigram_index()
+        leaderboards.refresh(force=True)
+        cache.bump_versions(
+            "movies", "ratings", "genres", "directors", "actors"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Catalog generated in {time.perf_counter() - start:.1f}s"
+            )
+        )
+
+    def reset_sequences(self):
+        # rows were inserted with explicit ids, sequence based databases
+        # have to continue after them
+        statements = connection.ops.sequence_reset_sql(
+            no_style(), [User, Director, Actor, Movie]
+        )
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def create_genres(self) -> List[int]:
+        MovieGenre.objects.bulk_create(
+            [MovieGenre(name=name) for name in GENRES], ignore_conflicts=True
+        )
+        return list(MovieGenre.objects.values_list("id", flat=True))
+
+    def create_rows(self, model, total: int, build) -> List[int]:
+        first = next_id(model)
+
+        for ids in batches(total, self.batch_size):
+            model.objects.bulk_create([build(first + i) for i in ids])
+
+        self.stdout.write(f"Created {total} {model._meta.verbose_name_plural}")
+        return list(range(first, first + total))
+
+    def insert_rows(self, model, columns: List[str], rows: List[tuple]):
+        """
+        Multi row INSERT of plain tuples. Skips building model
+        instances, which costs more than the insert itself at this scale.
+        """
+        if not rows:
+            return
+
+        quote = connection.ops.quote_name
+        fields = [model._meta.get_field(name) for name in columns]
+        column_sql = ", ".join(quote(field.column) for field in fields)
+        row_sql = "(" + ", ".join(["%s"] * len(fields)) + ")"
+        size = max(
+            1,
+            min(self.batch_size, connection.ops.bulk_batch_size(fields, rows)),
+        )
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), size):
+                chunk = rows[start : start + size]
+                cursor.execute(
+                    f"INSERT INTO {quote(model._meta.db_table)} "
+                    f"({column_sql}) VALUES "
+                    + ", ".join([row_sql] * len(chunk)),
+                    [value for row in chunk for value in row],
+                )
+
+    def default_thumbnail_size(self):
+        """
+        Width and height of the default thumbnail. Movies without them
+        would open the image every time one is loaded.
+        """
+        name = Movie._meta.get_field("thumbnail").default
+
+        try:
+            with default_storage.open(name) as file:
+                width, height = get_image_dimensions(file)
+        except OSError as e:
+            raise CommandError(f"Can not read the default thumbnail: {e}")
+
+        if width is None:
+            raise CommandError(f"The default thumbnail {name} is no image")
+
+        return name, width, height
+
+    def create_movies(
+        self,
+        total: int,
+        genre_ids: List[int],
+        director_ids: List[int],
+        actor_ids: List[int],
+    ) -> List[int]:
+        first = next_id(Movie)
+        rng = self.rng
+        # a few actors play in most of the movies
+        actors = PowerLaw(rng, actor_ids, self.skew) if actor_ids else None
+        today = connection.ops.adapt_datefield_value(self.today)
+        thumbnail, width, height = self.default_thumbnail_size()
+        columns = [
+            "id",
+            "title",
+            "added_date",
+            "produce_date",
+            "thumbnail",
+            "image_width",
+            "image_height",
+            "thumbnail_variants",
+            "thumbnail_variants_attempts",
+            "director",
+            "text",
+            "rating_sum",
+            "rating_count",
+            *(rating_bucket_field(bucket) for bucket in RATING_BUCKETS),
+        ]
+
+        for ids in batches(total, self.batch_size):
+            movies = []
+            genre_links = []
+            actor_links = []
+            grams = []
+
+            for i in ids:
+                id = first + i
+                title = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {id}"
+                movies.append(
+                    (
+                        id,
+                        title,
+                        today,
+                        connection.ops.adapt_datefield_value(
+                            date(1950, 1, 1)
+                            + timedelta(days=rng.randrange(365 * 70))
+                        ),
+                        thumbnail,
+                        width,
+                        height,
+                        "{}",
+                        0,
+                        rng.choice(director_ids) if director_ids else None,
+                        f"synthetic movie {id}",
+                        0,
+                        0,
+                        *[0] * len(RATING_BUCKETS),
+                    )
+                )
+                genre_links.extend(
+                    (id, genre)
+                    for genre in rng.sample(
+                        genre_ids, min(len(genre_ids), rng.randint(1, 3))
+                    )
+                )
+                if actors is not None:
+                    actor_links.extend(
+                        (id, actor)
+                        for actor in sorted(
+                            set(actors.sample(rng.randint(2, 6)))
+                        )
+                    )
+                if not search.uses_native_index(connection.alias):
+                    grams.extend(
+                        (id, gram)
+                        for gram in sorted(search.title_grams(title))
+                    )
+
+            with transaction.atomic():
+                self.insert_rows(Movie, columns, movies)
+                self.insert_rows(
+                    Movie.genres.through, ["movie", "moviegenre"], genre_links
+                )
+                self.insert_rows(
+                    Movie.actors.through, ["movie", "actor"], actor_links
+                )
+                self.insert_rows(MovieTitleGram, ["movie", "gram"], grams)
+
+        self.stdout.write(f"Created {total} movies")
+        return list(range(first, first + total))
+
+    def create_comments(
+        self, total: int, movie_ids: List[int], user_ids: List[int]
+    ):
+        if not movie_ids or not user_ids:
+            return
+
+        rng = self.rng
+        movies = PowerLaw(rng, movie_ids, self.skew)
+        users = PowerLaw(rng, user_ids, self.skew)
+        # every movie has its own quality the ratings gather around
+        quality = {id: rng.uniform(1, 4.5) for id in movie_ids}
+        days = [
+            connection.ops.adapt_datefield_value(
+                self.today - timedelta(days=day)
+            )
+            for day in range(365 * 5)
+        ]
+        columns = ["rating", "created", "text", "creator", "commented_movie"]
+
+        for ids in batches(total, self.batch_size):
+            with transaction.atomic():
+                self.insert_rows(
+                    Comment,
+                    columns,
+                    [
+                        (
+                            round(
+                                min(5, max(0, rng.gauss(quality[movie], 0.8))),
+                                1,
+                            ),
+                            rng.choice(days),
+                            rng.choice(PHRASES),
+                            user,
+                            movie,
+                        )
+                        for movie, user in zip(
+                            movies.sample(len(ids)), users.sample(len(ids))
+                        )
+                    ],
+                )
+
+        self.stdout.write(f"Created {total} comments")
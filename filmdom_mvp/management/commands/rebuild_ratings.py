@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from filmdom_mvp import cache, leaderboards
+from filmdom_mvp.models import Movie
+
+
+class Command(BaseCommand):
+    help = "Recomputes the stored rating aggregates of every movie"
+
+    def handle(self, *args, **options):
+        updated = Movie.rebuild_ratings()
+        cache.bump_versions("movies", "ratings")
+        leaderboards.mark_dirty(*leaderboards.RATING_BOARDS)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt rating aggregates of {updated} movies"
+            )
+        )
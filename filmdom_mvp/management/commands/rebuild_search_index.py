@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from filmdom_mvp import cache, search
+from filmdom_mvp.models import Movie
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the movie title search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        movies = Movie.objects.only("id", "title").order_by("id")
+        last_id = 0
+        indexed = 0
+
+        while True:
+            batch = list(movies.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            search.index_titles(batch)
+            indexed += len(batch)
+            last_id = batch[-1].id
+
+        search.create_trigram_index()
+        cache.bump_versions("movies")
+        self.stdout.write(
+            self.style.SUCCESS(f"Indexed titles of {indexed} movies")
+        )
@@ -1,6 +1,55 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import MD5, Cast, Coalesce, Concat
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.auth.models import User
+from collections import Counter
+from typing import Dict, Optional
+
+# sort keys of the rating orderings, unrated movies always come last.
+# Queries have to use the very same expressions to hit the indexes.
+BEST_RATING_KEY = Coalesce("average_rating", models.Value(-1.0))
+WORST_RATING_KEY = Coalesce("average_rating", models.Value(6.0))
+
+# the rating histogram has a bucket for every whole rating,
+# a rating of n up to n + 1 is counted as n
+RATING_BUCKETS = range(6)
+
+# seeds drawn for shuffles that were requested without one
+SHUFFLE_SEEDS = 2**31
+
+
+def rating_bucket(rating: float) -> int:
+    return min(int(rating), RATING_BUCKETS[-1])
+
+
+def rating_bucket_filter(bucket: int) -> models.Q:
+    if bucket == RATING_BUCKETS[-1]:
+        return models.Q(rating__gte=bucket)
+
+    return models.Q(rating__gte=bucket, rating__lt=bucket + 1)
+
+
+def rating_bucket_field(bucket: int) -> str:
+    return f"rating_count_{bucket}"
+
+
+def shuffle_key(seed) -> MD5:
+    """
+    Sort key putting rows in a pseudo random order that only depends
+    on the seed: the md5 of the seed and the id. It is computed by the
+    database, so shuffled pages are sorted there and nothing is loaded
+    up front. Hashing every id costs about as much as the arithmetic
+    key it replaces, but unlike `(a * id + b) mod p` consecutive ids
+    do not land a fixed stride apart.
+    """
+    return MD5(
+        Concat(
+            models.Value(f"{seed}:"),
+            Cast("id", models.CharField()),
+            output_field=models.CharField(),
+        )
+    )
 
 
 class MovieGenre(models.Model):
@@ -26,6 +75,7 @@ class Actor(models.Model):
 
 class Movie(models.Model):
     title = models.CharField(max_length=256, unique=True)
+    tmdb_id = models.PositiveIntegerField(unique=True, null=True, blank=True)
     added_date = models.DateField(auto_now_add=True)
     produce_date = models.DateField()
     image_height = models.PositiveIntegerField(
@@ -47,6 +97,16 @@ class Movie(models.Model):
     )
 
     remote_thumbnail = models.URLField(blank=True, null=True)
+    # downscaled copies of the thumbnail by name, made in the background
+    # from `thumbnail_variants_source` (see thumbnails.py)
+    thumbnail_variants = models.JSONField(default=dict, blank=True)
+    thumbnail_variants_source = models.CharField(
+        max_length=255, null=True, blank=True
+    )
+    # downloads of the source that failed on a transient error, the
+    # next one waits until `thumbnail_variants_retry_at`
+    thumbnail_variants_attempts = models.PositiveIntegerField(default=0)
+    thumbnail_variants_retry_at = models.DateTimeField(null=True, blank=True)
 
     genres = models.ManyToManyField(MovieGenre, blank=True)
     director = models.ForeignKey(
@@ -55,16 +115,231 @@ class Movie(models.Model):
     actors = models.ManyToManyField(Actor, blank=True)
     text = models.CharField(blank=True, null=True, max_length=4096)
 
-    @property
-    def average_rating(self):
-        return self.comments.aggregate(avg_score=models.Avg("rating"))[
-            "avg_score"
+    # denormalized rating aggregates, kept in sync by the comment signals
+    # (see signals.py) and rebuilt with the `rebuild_ratings` command
+    rating_sum = models.FloatField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    average_rating = models.FloatField(null=True, blank=True)
+    # rating histogram, the number of ratings in every bucket
+    rating_count_0 = models.PositiveIntegerField(default=0)
+    rating_count_1 = models.PositiveIntegerField(default=0)
+    rating_count_2 = models.PositiveIntegerField(default=0)
+    rating_count_3 = models.PositiveIntegerField(default=0)
+    rating_count_4 = models.PositiveIntegerField(default=0)
+    rating_count_5 = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                BEST_RATING_KEY.desc(), F("id").desc(), name="movie_best_idx"
+            ),
+            models.Index(WORST_RATING_KEY, "id", name="movie_worst_idx"),
+            models.Index(
+                fields=["rating_count", "id"], name="movie_popularity_idx"
+            ),
         ]
 
+    @classmethod
+    def apply_rating_change(
+        cls,
+        movie_id: int,
+        added: Optional[float] = None,
+        removed: Optional[float] = None,
+    ):
+        """
+        Atomically moves the stored rating aggregates of a movie from
+        the `removed` rating to the `added` one (either can be None).
+        Both updates run in one transaction and rely on the database
+        to do the arithmetic, so concurrent comment writes never lose
+        an update.
+        """
+        rating_delta = (added or 0) - (removed or 0)
+        count_delta = (added is not None) - (removed is not None)
+        buckets = Counter()
+
+        if added is not None:
+            buckets[rating_bucket(added)] += 1
+        if removed is not None:
+            buckets[rating_bucket(removed)] -= 1
+
+        histogram = {
+            rating_bucket_field(bucket): F(rating_bucket_field(bucket)) + delta
+            for bucket, delta in buckets.items()
+            if delta
+        }
+
+        with transaction.atomic():
+            cls.objects.filter(pk=movie_id).update(
+                rating_sum=F("rating_sum") + rating_delta,
+                rating_count=F("rating_count") + count_delta,
+                **histogram,
+            )
+            cls.objects.filter(pk=movie_id).update(
+                average_rating=cls.average_rating_expression()
+            )
+
+    @classmethod
+    def rebuild_ratings(cls) -> int:
+        """
+        Recomputes the rating aggregates of every movie from the
+        comments table. Returns the number of updated movies.
+        """
+        comments = Comment.objects.filter(
+            commented_movie=models.OuterRef("pk")
+        ).values("commented_movie")
+
+        with transaction.atomic():
+            updated = cls.objects.update(
+                rating_sum=Coalesce(
+                    models.Subquery(
+                        comments.annotate(s=models.Sum("rating")).values("s")
+                    ),
+                    0.0,
+                ),
+                rating_count=Coalesce(
+                    models.Subquery(
+                        comments.annotate(c=models.Count("id")).values("c")
+                    ),
+                    0,
+                ),
+                **{
+                    rating_bucket_field(bucket): Coalesce(
+                        models.Subquery(
+                            comments.filter(rating_bucket_filter(bucket))
+                            .annotate(c=models.Count("id"))
+                            .values("c")
+                        ),
+                        0,
+                    )
+                    for bucket in RATING_BUCKETS
+                },
+            )
+            cls.objects.update(average_rating=cls.average_rating_expression())
+
+        return updated
+
+    @staticmethod
+    def average_rating_expression():
+        return models.Case(
+            models.When(rating_count=0, then=None),
+            default=F("rating_sum") / F("rating_count"),
+            output_field=models.FloatField(),
+        )
+
+    def rating_histogram(self) -> Dict[int, int]:
+        return {
+            bucket: getattr(self, rating_bucket_field(bucket))
+            for bucket in RATING_BUCKETS
+        }
+
     def __str__(self):
         return f"Name: {self.title} | rating:{self.average_rating}"
 
 
+class MovieTitleGram(models.Model):
+    """
+    Trigram index of movie titles, used by the title search on
+    databases without native trigram indexes (see search.py)
+    """
+
+    movie = models.ForeignKey(
+        Movie, on_delete=models.CASCADE, related_name="title_grams"
+    )
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["gram", "movie"], name="unique_title_gram"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.gram} | movie: {self.movie_id}"
+
+
+class IngestionRun(models.Model):
+    """
+    Import of one daily TMDB export. It is updated after every saved
+    batch, so an interrupted run is picked up where it stopped.
+    The entries are fetched in `chunks`, the run is finished when
+    the last of them completes.
+    """
+
+    export_date = models.DateField(unique=True)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    requested = models.PositiveIntegerField(default=0)
+    saved = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    chunks = models.PositiveIntegerField(default=0)
+    completed_chunks = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Export: {self.export_date} | saved: {self.saved}"
+
+
+class SkippedTmdbEntry(models.Model):
+    """
+    Export entries which can not be imported, e.g. without a release
+    date. They are left out of the following runs.
+    """
+
+    tmdb_id = models.PositiveIntegerField(unique=True)
+    reason = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f"{self.tmdb_id} | {self.reason}"
+
+
+class Leaderboard(models.Model):
+    """
+    Materialized ranking of all movies for one popular sort method,
+    rebuilt in the background (see leaderboards.py). Comment writes
+    mark the rating boards `dirty`, the refresh task rebuilds only
+    the dirty ones.
+    """
+
+    name = models.CharField(max_length=32, unique=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+    dirty = models.BooleanField(default=True)
+
+    def __str__(self):
+        return f"{self.name} | refreshed: {self.refreshed_at}"
+
+
+class LeaderboardEntry(models.Model):
+    leaderboard = models.ForeignKey(
+        Leaderboard, on_delete=models.CASCADE, related_name="entries"
+    )
+    movie = models.ForeignKey(
+        Movie, on_delete=models.CASCADE, related_name="leaderboard_entries"
+    )
+    rank = models.PositiveIntegerField()
+    # the sort key of the movie on the board, if it has its own
+    score = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["leaderboard", "movie"],
+                name="unique_leaderboard_movie",
+            )
+        ]
+        # not unique, ranks pass through duplicates while a board
+        # is updated in place
+        indexes = [
+            models.Index(
+                fields=["leaderboard", "rank"], name="leaderboard_rank_idx"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.leaderboard_id} | {self.rank}. movie: {self.movie_id}"
+
+
 class Comment(models.Model):
     rating = models.FloatField(
         validators=[MaxValueValidator(5), MinValueValidator(0)]
@@ -77,6 +352,19 @@ class Comment(models.Model):
         Movie, on_delete=models.CASCADE, related_name="comments"
     )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created", "id"], name="comment_created_idx"),
+            models.Index(
+                fields=["commented_movie", "created", "id"],
+                name="comment_movie_created_idx",
+            ),
+            models.Index(
+                fields=["creator", "created", "id"],
+                name="comment_creator_created_idx",
+            ),
+        ]
+
     def __str__(self):
         return (
             f"Creator: {self.creator.username} | "
@@ -0,0 +1,214 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+from typing import List, Optional, Tuple
+import json
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor (keyset) pagination. Instead of an OFFSET the cursor stores
+    the ordering values of the last row of the page and the next page
+    starts right after them, so every page costs the same and no
+    COUNT(*) is needed.
+
+    Ordering is read from the queryset itself, so it has to be ordered
+    by plain field or annotation names only, and the last of them
+    has to be unique (e.g. the id).
+
+    A view serving one sort from differently built querysets sets
+    `cursor_tag` to tell them apart. Cursors carry the tag they were
+    made with and are rejected by another queryset, their values would
+    point to the wrong rows.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    invalid_cursor_message = "Invalid cursor"
+    stale_cursor_message = (
+        "Outdated cursor, the ordering has changed since. "
+        "Start from the first page."
+    )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+        self.cursor_tag = getattr(view, "cursor_tag", None)
+        position = self.decode_cursor(request)
+
+        if position is not None:
+            position = self.convert_position(queryset, position)
+            queryset = queryset.filter(self.rows_after(position))
+
+        # fetching one row more tells us if there is a next page
+        results = list(queryset[: self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[: self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        if page_size < 1:
+            return self.page_size
+
+        return min(page_size, self.max_page_size)
+
+    @staticmethod
+    def get_ordering(queryset) -> List[Tuple[str, bool]]:
+        """
+        Returns ordering of the queryset as (name, descending) pairs
+        """
+        ordering = []
+
+        for field in queryset.query.order_by:
+            if not isinstance(field, str):
+                raise ImproperlyConfigured(
+                    "Keyset pagination supports ordering "
+                    "by field or annotation names only"
+                )
+            ordering.append((field.lstrip("-"), field.startswith("-")))
+
+        if not ordering:
+            raise ImproperlyConfigured(
+                "Keyset pagination requires an ordered queryset"
+            )
+
+        return ordering
+
+    def convert_position(self, queryset, position: list) -> list:
+        """
+        Converts the cursor values to the types of the ordering
+        fields, a value of another type makes the cursor invalid
+        """
+        converted = []
+
+        for (name, _), value in zip(self.ordering, position):
+            annotation = queryset.query.annotations.get(name)
+            field = (
+                annotation.output_field
+                if annotation is not None
+                else queryset.model._meta.get_field(name)
+            )
+
+            if isinstance(value, (dict, list)):
+                raise NotFound(self.invalid_cursor_message)
+
+            try:
+                converted.append(field.to_python(value))
+            except (ValueError, TypeError, DjangoValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        return converted
+
+    def rows_after(self, position: list) -> Q:
+        """
+        Builds the `(a, b, ...) > (x, y, ...)` row comparison.
+        The leading non-strict bound on the first key lets the
+        database turn it into an index range scan.
+        """
+        condition = None
+
+        for (name, descending), value in reversed(
+            list(zip(self.ordering, position))
+        ):
+            lookup = "lt" if descending else "gt"
+            after = Q(**{f"{name}__{lookup}": value})
+
+            if condition is not None:
+                after |= Q(**{name: value}) & condition
+
+            condition = after
+
+        first_name, first_descending = self.ordering[0]
+        bound = "lte" if first_descending else "gte"
+        return Q(**{f"{first_name}__{bound}": position[0]}) & condition
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.has_next:
+            return None
+
+        last = self.page[-1]
+        position = [getattr(last, name) for name, _ in self.ordering]
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(position, self.cursor_tag),
+        )
+
+    @staticmethod
+    def encode_cursor(position: list, tag: Optional[str] = None) -> str:
+        data = json.dumps({"position": position, "tag": tag}, default=str)
+        return b64encode(data.encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, request) -> Optional[list]:
+        encoded = request.query_params.get(self.cursor_query_param)
+
+        if not encoded:
+            return None
+
+        try:
+            cursor = json.loads(b64decode(encoded.encode("ascii")))
+            position = cursor["position"]
+            tag = cursor["tag"]
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if tag != self.cursor_tag:
+            raise NotFound(self.stale_cursor_message)
+
+        if (
+            not isinstance(position, list)
+            or len(position) != len(self.ordering)
+            or None in position
+        ):
+            raise NotFound(self.invalid_cursor_message)
+
+        return position
+
+
+class KeysetPaginationMixin:
+    """
+    Lets a viewset switch to keyset pagination on request,
+    with `?pagination=cursor` or by passing a cursor
+    """
+
+    keyset_pagination_class = KeysetPagination
+    cursor_tag = None
+
+    def uses_keyset_pagination(self) -> bool:
+        params = self.request.query_params
+        return (
+            params.get("pagination") == "cursor"
+            or KeysetPagination.cursor_query_param in params
+        )
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator") and self.uses_keyset_pagination():
+            self._paginator = self.keyset_pagination_class()
+
+        return super().paginator
@@ -12,7 +12,8 @@ class IsOwnerOrReadonly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return obj.creator == request.user
+        # comparing the ids spares loading the creator
+        return obj.creator_id == request.user.pk
 
 
 class CreationAllowed(permissions.BasePermission):
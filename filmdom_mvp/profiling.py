@@ -0,0 +1,296 @@
+"""
+Counting the database work of a block of code: executed queries,
+their time and the rows fetched from the database.
+
+ProfilingMiddleware reports these numbers for every request, together
+with the time spent in serializers, as `Server-Timing` headers and a
+log line. It is enabled with the REQUEST_PROFILING setting and removes
+itself from the middleware chain otherwise.
+
+The counting block is looked up in the context of the query, so the
+queries the async views run in worker threads are counted as well.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework import serializers
+from typing import FrozenSet, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.duration = 0.0
+        # executions of every SQL statement, parameters aside
+        self.statements = Counter()
+        # queries run on every database alias
+        self.databases = Counter()
+
+    def duplicates(self, threshold: int = 2) -> List[tuple]:
+        """
+        Statements executed at least `threshold` times, the usual
+        trace of an N+1 query pattern
+        """
+        return [
+            (sql, count)
+            for sql, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+
+class CountingCursorWrapper(CursorWrapper):
+    """
+    Cursor wrapper adding the executed queries and the fetched
+    rows up in `stats`
+    """
+
+    def __init__(self, cursor, db, stats: QueryStats):
+        super().__init__(cursor, db)
+        self.stats = stats
+
+    def execute(self, sql, params=None):
+        return self.timed(super().execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(super().executemany, sql, param_list)
+
+    def timed(self, execute, sql, params):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params)
+        finally:
+            self.stats.queries += 1
+            self.stats.duration += time.perf_counter() - start
+            self.stats.statements[sql] += 1
+            self.stats.databases[self.db.alias] += 1
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = (
+            self.cursor.fetchmany()
+            if size is None
+            else self.cursor.fetchmany(size)
+        )
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.stats.rows += 1
+            yield row
+
+
+# the innermost count_queries block, as its stats and aliases
+current_counter: ContextVar[
+    Optional[Tuple[QueryStats, FrozenSet[str]]]
+] = ContextVar("current_query_counter", default=None)
+
+
+@contextmanager
+def count_queries(*aliases: str):
+    """
+    Counts the queries run inside the block on the connections of the
+    aliases (all of them by default, e.g. the read replicas too),
+    including the rows they returned
+    """
+    stats = QueryStats()
+    aliases = frozenset(aliases or connections)
+
+    for alias in aliases:
+        instrument(connections[alias])
+
+    token = current_counter.set((stats, aliases))
+    try:
+        yield stats
+    finally:
+        current_counter.reset(token)
+
+
+def instrument(connection):
+    """
+    Lets count_queries see the cursors of the connection. Connections
+    are per thread, signals.py instruments every new one.
+    """
+    if getattr(connection, "counts_queries", False):
+        return
+
+    # instance attributes shadow the methods of the connection,
+    # the debug cursor is replaced as well to cover DEBUG = True
+    for name in ("make_cursor", "make_debug_cursor"):
+        setattr(
+            connection,
+            name,
+            counting_cursor_factory(connection, getattr(connection, name)),
+        )
+    connection.counts_queries = True
+
+
+def counting_cursor_factory(connection, make_cursor):
+    def make_counting_cursor(cursor):
+        counter = current_counter.get()
+
+        if counter is None or connection.alias not in counter[1]:
+            return make_cursor(cursor)
+
+        return CountingCursorWrapper(cursor, connection, counter[0])
+
+    return make_counting_cursor
+
+
+class RequestProfile:
+    def __init__(self):
+        self.serializer_duration = 0.0
+
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar(
+    "current_profile", default=None
+)
+
+
+@contextmanager
+def serializer_timer():
+    profile = current_profile.get()
+
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.serializer_duration += time.perf_counter() - start
+
+
+class ProfiledSerializerMixin:
+    """
+    Adds the time spent building `data` to the profile of the current
+    request. List serializers need `ProfiledListSerializer` set as
+    `Meta.list_serializer_class`.
+    """
+
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class ProfiledListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Measures the queries, database time, serializer time and the total
+    time of every request
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_PROFILING:
+            raise MiddlewareNotUsed
+
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+
+        try:
+            with count_queries() as stats:
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+
+        self.report(request, response, stats, profile, start)
+        return response
+
+    async def __acall__(self, request):
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+
+        try:
+            with count_queries() as stats:
+                response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+
+        self.report(request, response, stats, profile, start)
+        return response
+
+    def report(
+        self,
+        request,
+        response,
+        stats: QueryStats,
+        profile: RequestProfile,
+        start: float,
+    ):
+        total = time.perf_counter() - start
+        duplicates = stats.duplicates(settings.REQUEST_PROFILING_DUPLICATES)
+        response["Server-Timing"] = ", ".join(
+            [
+                f'db;dur={stats.duration * 1000:.2f};desc="{stats.queries} '
+                'queries"',
+                f"serializer;dur={profile.serializer_duration * 1000:.2f}",
+                f"total;dur={total * 1000:.2f}",
+            ]
+        )
+        logger.info(
+            json.dumps(
+                {
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "queries": stats.queries,
+                    "databases": dict(stats.databases),
+                    "rows": stats.rows,
+                    "db_ms": round(stats.duration * 1000, 2),
+                    "serializer_ms": round(
+                        profile.serializer_duration * 1000, 2
+                    ),
+                    "total_ms": round(total * 1000, 2),
+                    "duplicate_queries": [
+                        {"sql": sql, "count": count}
+                        for sql, count in duplicates
+                    ],
+                }
+            )
+        )
+
+        if duplicates:
+            sql, count = duplicates[0]
+            logger.warning(
+                f"{request.method} {request.path} ran a query {count} times, "
+                f"possible N+1: {sql}"
+            )
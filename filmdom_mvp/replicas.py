@@ -0,0 +1,241 @@
+"""
+Read replica routing.
+
+ReplicaMiddleware lets the reads of GET/HEAD/OPTIONS requests go to
+one of the DATABASE_REPLICAS, everything else stays on "default":
+writes, the reads of other requests, Celery tasks and management
+commands.
+
+A client that has just written is pinned to the primary for
+REPLICA_PIN_SECONDS, so it reads its own writes even if the replicas
+are behind. The pins are kept in the cache, which has to be shared
+between the processes for them to work across the deployment. A
+replica lagging more than REPLICA_MAX_LAG seconds or failing its
+check is left out until the next check, when no replica is usable the
+reads fall back to the primary.
+
+Locally, a replica can be any alias of DATABASES, e.g. a copy of the
+SQLite database file.
+
+The middleware is async capable, so under ASGI it does not push the
+async views through the single thread the sync code runs in.
+"""
+
+from asgiref.sync import sync_to_async
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+from django.utils.deprecation import MiddlewareMixin
+from hashlib import md5
+from rest_framework.permissions import SAFE_METHODS
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import random
+import threading
+import time
+
+PIN_KEY = "replica-pin:{}"
+
+
+class ReadState:
+    def __init__(self, use_replica: bool):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+current_state: ContextVar[Optional[ReadState]] = ContextVar(
+    "replica_read_state", default=None
+)
+
+
+@contextmanager
+def replica_reads(use_replica: bool = True):
+    """
+    Routes the reads of the block, the middleware wraps every request
+    """
+    state = ReadState(use_replica)
+    token = current_state.set(state)
+    try:
+        yield state
+    finally:
+        current_state.reset(token)
+
+
+def replica_lag(alias: str) -> Optional[float]:
+    """
+    Seconds the replica is behind its primary, None when unknown
+    """
+    connection = connections[alias]
+
+    if connection.vendor != "postgresql":
+        return 0.0
+
+    with connection.cursor() as cursor:
+        # a replica that has replayed everything it received is not
+        # behind, however old its last transaction is
+        cursor.execute(
+            "SELECT CASE"
+            " WHEN NOT pg_is_in_recovery() THEN 0"
+            " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()"
+            " THEN 0"
+            " ELSE EXTRACT("
+            "EPOCH FROM now() - pg_last_xact_replay_timestamp()"
+            ") END"
+        )
+        lag = cursor.fetchone()[0]
+
+    return None if lag is None else float(lag)
+
+
+class ReplicaHealth:
+    """
+    Process wide results of the replica checks, each one reused for
+    REPLICA_HEALTH_CHECK_INTERVAL seconds
+    """
+
+    def __init__(self):
+        self.checks: Dict[str, Tuple[float, bool]] = {}
+        self.lock = threading.Lock()
+
+    def is_usable(self, alias: str) -> bool:
+        now = time.monotonic()
+
+        with self.lock:
+            checked = self.checks.get(alias)
+            if checked is not None and checked[0] > now:
+                return checked[1]
+
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError:
+            lag = None
+
+        usable = lag is not None and lag <= settings.REPLICA_MAX_LAG
+
+        with self.lock:
+            self.checks[alias] = (
+                now + settings.REPLICA_HEALTH_CHECK_INTERVAL,
+                usable,
+            )
+
+        return usable
+
+    def clear(self):
+        with self.lock:
+            self.checks.clear()
+
+
+replica_health = ReplicaHealth()
+
+
+def usable_replicas() -> List[str]:
+    return [
+        alias
+        for alias in settings.DATABASE_REPLICAS
+        if replica_health.is_usable(alias)
+    ]
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = current_state.get()
+
+        if state is None or not state.use_replica or state.wrote:
+            return "default"
+
+        replicas = usable_replicas()
+
+        if not replicas:
+            return "default"
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = current_state.get()
+
+        # the rest of the request reads what it has written
+        if state is not None:
+            state.wrote = True
+
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {"default", *settings.DATABASE_REPLICAS}
+
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+
+        return None
+
+
+def client_identity(request) -> Optional[str]:
+    """
+    The token or session of the request, hashed, None for anonymous
+    clients which have no writes to read back
+    """
+    credentials = request.META.get(
+        "HTTP_AUTHORIZATION"
+    ) or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+
+    if not credentials:
+        return None
+
+    return md5(credentials.encode("utf-8")).hexdigest()
+
+
+class ReplicaMiddleware(MiddlewareMixin):
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        use_replica = self.use_replica(request)
+
+        with replica_reads(use_replica) as state:
+            response = self.get_response(request)
+
+        self.finish(request, state)
+        return response
+
+    async def __acall__(self, request):
+        # the pins are only looked up with replicas, the cache
+        # is not touched from the event loop otherwise
+        if not settings.DATABASE_REPLICAS:
+            with replica_reads(False):
+                return await self.get_response(request)
+
+        use_replica = await sync_to_async(
+            self.use_replica, thread_sensitive=False
+        )(request)
+
+        with replica_reads(use_replica) as state:
+            response = await self.get_response(request)
+
+        await sync_to_async(self.finish, thread_sensitive=False)(
+            request, state
+        )
+        return response
+
+    def use_replica(self, request) -> bool:
+        return (
+            bool(settings.DATABASE_REPLICAS)
+            and request.method in SAFE_METHODS
+            and not self.is_pinned(client_identity(request))
+        )
+
+    def finish(self, request, state: ReadState):
+        if state.wrote or request.method not in SAFE_METHODS:
+            self.pin(client_identity(request))
+
+    def is_pinned(self, identity: Optional[str]) -> bool:
+        if identity is None:
+            return False
+
+        return cache.get(PIN_KEY.format(identity), False)
+
+    def pin(self, identity: Optional[str]):
+        if identity is not None and settings.DATABASE_REPLICAS:
+            cache.set(
+                PIN_KEY.format(identity), True, settings.REPLICA_PIN_SECONDS
+            )
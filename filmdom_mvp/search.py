@@ -0,0 +1,109 @@
+"""
+Movie title search behind the `title_like` parameter.
+
+On PostgreSQL the substring lookup is served by a GIN trigram index
+on UPPER(title), which is exactly what `icontains` compiles to.
+Other databases (SQLite in tests) use the MovieTitleGram table, which
+holds every trigram of every title and is kept up to date by the
+movie signals and `index_titles`.
+"""
+
+from django.db import connections, transaction
+from django.db.models import Case, Count, FloatField, Value, When
+from django.db.models.functions import Length
+from typing import Iterable, Set
+from .models import Movie, MovieTitleGram
+
+GRAM_SIZE = 3
+
+
+def uses_native_index(using: str) -> bool:
+    return connections[using].vendor == "postgresql"
+
+
+def title_grams(text: str) -> Set[str]:
+    text = text.lower()
+    return {text[i : i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+def search_movies(queryset, text: str):
+    """
+    Filters the movie queryset down to titles containing the text,
+    ignoring case
+    """
+    queryset = queryset.filter(title__icontains=text)
+    grams = title_grams(text)
+
+    if uses_native_index(queryset.db) or not grams:
+        return queryset
+
+    # only titles containing every trigram of the text can match,
+    # icontains above just confirms the candidates
+    candidates = (
+        MovieTitleGram.objects.filter(gram__in=grams)
+        .values("movie")
+        .annotate(matched=Count("gram"))
+        .filter(matched=len(grams))
+        .values("movie")
+    )
+    return queryset.filter(id__in=candidates)
+
+
+def annotate_relevance(queryset, text: str):
+    """
+    Adds a `relevance` annotation, the higher the better the title
+    matches the text
+    """
+    if uses_native_index(queryset.db):
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        return queryset.annotate(relevance=TrigramSimilarity("title", text))
+
+    # exact matches first, then prefixes, shorter titles break the tie
+    return queryset.annotate(
+        relevance=Case(
+            When(title__iexact=text, then=Value(2.0)),
+            When(title__istartswith=text, then=Value(1.0)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+        + Value(1.0) / Length("title")
+    )
+
+
+def index_titles(movies: Iterable[Movie], using: str = "default"):
+    """
+    Rebuilds the trigram rows of given movies. Has to be called
+    for movies created without signals, e.g. with bulk_create.
+    """
+    if uses_native_index(using):
+        return
+
+    movies = list(movies)
+    with transaction.atomic(using=using):
+        MovieTitleGram.objects.using(using).filter(movie__in=movies).delete()
+        MovieTitleGram.objects.using(using).bulk_create(
+            [
+                MovieTitleGram(movie=movie, gram=gram)
+                for movie in movies
+                for gram in title_grams(movie.title)
+            ],
+            batch_size=1000,
+        )
+
+
+def create_trigram_index(using: str = "default", **kwargs):
+    """
+    post_migrate hook creating the PostgreSQL trigram index,
+    the other databases get the MovieTitleGram table instead
+    """
+    if not uses_native_index(using):
+        return
+
+    with connections[using].cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS movie_title_trgm_idx "
+            f"ON {Movie._meta.db_table} "
+            "USING gin (UPPER(title) gin_trgm_ops)"
+        )
@@ -1,6 +1,17 @@
 from django.contrib.auth.models import User, Group
-from .models import MovieGenre, Movie, Director, Actor, Comment
+from django.core.files.storage import default_storage
+from .models import (
+    RATING_BUCKETS,
+    MovieGenre,
+    Movie,
+    Director,
+    Actor,
+    Comment,
+    rating_bucket_field,
+)
 from rest_framework import serializers
+from .fieldsets import SparseFieldsSerializerMixin
+from .profiling import ProfiledListSerializer, ProfiledSerializerMixin
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -24,37 +35,91 @@ class GroupSerializer(serializers.ModelSerializer):
         fields = ["url", "name"]
 
 
-class MovieSerializer(serializers.ModelSerializer):
-    average_rating = serializers.ReadOnlyField()
+class MovieSerializer(
+    SparseFieldsSerializerMixin,
+    ProfiledSerializerMixin,
+    serializers.ModelSerializer,
+):
     director_name = serializers.ReadOnlyField(source="director.name")
+    thumbnail_variants = serializers.SerializerMethodField()
+    rating_histogram = serializers.SerializerMethodField()
 
     class Meta:
         model = Movie
-        fields = "__all__"
-
-
-class MovieGenreSerializer(serializers.ModelSerializer):
+        exclude = [
+            "rating_sum",
+            "thumbnail_variants_source",
+            *(rating_bucket_field(bucket) for bucket in RATING_BUCKETS),
+        ]
+        read_only_fields = ["rating_count", "average_rating"]
+        list_serializer_class = ProfiledListSerializer
+
+    def get_thumbnail_variants(self, movie: Movie) -> dict:
+        """
+        Downscaled thumbnails by name, empty until they are made
+        """
+        request = self.context.get("request")
+        variants = {}
+
+        for name, variant in movie.thumbnail_variants.items():
+            url = default_storage.url(variant["image"])
+            if request is not None:
+                url = request.build_absolute_uri(url)
+
+            variants[name] = {
+                "url": url,
+                "width": variant["width"],
+                "height": variant["height"],
+            }
+
+        return variants
+
+    def get_rating_histogram(self, movie: Movie) -> dict:
+        """
+        Number of ratings by whole rating, a 4.5 counts as a 4
+        """
+        return {
+            str(bucket): count
+            for bucket, count in movie.rating_histogram().items()
+        }
+
+
+class MovieGenreSerializer(
+    ProfiledSerializerMixin, serializers.ModelSerializer
+):
     class Meta:
         model = MovieGenre
         fields = "__all__"
+        list_serializer_class = ProfiledListSerializer
 
 
-class DirectorSerializer(serializers.ModelSerializer):
+class DirectorSerializer(
+    ProfiledSerializerMixin, serializers.ModelSerializer
+):
     class Meta:
         model = Director
         fields = "__all__"
+        list_serializer_class = ProfiledListSerializer
 
 
-class ActorSerializer(serializers.ModelSerializer):
+class ActorSerializer(
+    ProfiledSerializerMixin, serializers.ModelSerializer
+):
     class Meta:
         model = Actor
         fields = "__all__"
+        list_serializer_class = ProfiledListSerializer
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(
+    SparseFieldsSerializerMixin,
+    ProfiledSerializerMixin,
+    serializers.ModelSerializer,
+):
     creator_name = serializers.ReadOnlyField(source="creator.username")
     movie_title = serializers.ReadOnlyField(source="commented_movie.title")
 
     class Meta:
         model = Comment
         fields = "__all__"
+        list_serializer_class = ProfiledListSerializer
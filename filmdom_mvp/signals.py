@@ -0,0 +1,152 @@
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_save,
+)
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .models import Actor, Comment, Director, Movie, MovieGenre
+from . import authentication, cache, leaderboards, profiling, search
+
+
+@receiver(pre_save, sender=Comment)
+def remember_previous_rating(sender, instance: Comment, **kwargs):
+    """
+    Stores the rating and movie the comment had before this save,
+    so the aggregates can be corrected once the new values are written.
+    """
+    instance._previous_rating = None
+
+    if instance.pk is None:
+        return
+
+    instance._previous_rating = (
+        Comment.objects.filter(pk=instance.pk)
+        .values_list("commented_movie_id", "rating")
+        .first()
+    )
+
+
+@receiver(post_save, sender=Comment)
+def update_rating_on_save(sender, instance: Comment, **kwargs):
+    previous = getattr(instance, "_previous_rating", None)
+
+    if previous is None:
+        Movie.apply_rating_change(
+            instance.commented_movie_id, added=instance.rating
+        )
+        return
+
+    previous_movie_id, previous_rating = previous
+
+    if previous_movie_id == instance.commented_movie_id:
+        if previous_rating != instance.rating:
+            Movie.apply_rating_change(
+                instance.commented_movie_id,
+                added=instance.rating,
+                removed=previous_rating,
+            )
+        return
+
+    # comment was moved to another movie
+    Movie.apply_rating_change(previous_movie_id, removed=previous_rating)
+    Movie.apply_rating_change(
+        instance.commented_movie_id, added=instance.rating
+    )
+
+
+@receiver(post_delete, sender=Comment)
+def update_rating_on_delete(sender, instance: Comment, **kwargs):
+    # also fired for cascades; updating a movie that is about to be
+    # deleted together with its comments is harmless
+    Movie.apply_rating_change(
+        instance.commented_movie_id, removed=instance.rating
+    )
+
+
+@receiver(post_save, sender=Movie)
+def index_movie_title(sender, instance: Movie, using, update_fields, **kwargs):
+    if update_fields is not None and "title" not in update_fields:
+        return
+
+    search.index_titles([instance], using=using)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_movie_ratings(sender, instance: Comment, **kwargs):
+    previous = getattr(instance, "_previous_rating", None) or ()
+    movie_ids = {instance.commented_movie_id, *previous[:1]}
+    cache.bump_versions_on_commit(
+        "ratings", *(f"movies:{pk}" for pk in movie_ids)
+    )
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def invalidate_movie(sender, instance: Movie, **kwargs):
+    cache.bump_versions_on_commit("movies", f"movies:{instance.pk}")
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def dirty_rating_leaderboards(sender, **kwargs):
+    leaderboards.mark_dirty(*leaderboards.RATING_BOARDS)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def dirty_leaderboards(sender, **kwargs):
+    leaderboards.mark_dirty()
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+@receiver(m2m_changed, sender=Movie.actors.through)
+def invalidate_movie_relations(sender, **kwargs):
+    cache.bump_versions_on_commit("movies")
+
+
+@receiver(post_save, sender=MovieGenre)
+@receiver(post_delete, sender=MovieGenre)
+def invalidate_genres(sender, **kwargs):
+    cache.bump_versions_on_commit("genres", "movies")
+
+
+@receiver(post_save, sender=Director)
+@receiver(post_delete, sender=Director)
+def invalidate_directors(sender, **kwargs):
+    cache.bump_versions_on_commit("directors", "movies")
+
+
+@receiver(post_save, sender=Actor)
+@receiver(post_delete, sender=Actor)
+def invalidate_actors(sender, **kwargs):
+    cache.bump_versions_on_commit("actors", "movies")
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance: Token, **kwargs):
+    authentication.forget_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(
+    sender, instance: User, created: bool, update_fields=None, **kwargs
+):
+    # new users have no token, logins only touch last_login
+    if created or (update_fields and set(update_fields) <= {"last_login"}):
+        return
+
+    # cached users would keep e.g. an outdated is_active or is_staff
+    for key in Token.objects.filter(user=instance).values_list(
+        "key", flat=True
+    ):
+        authentication.forget_token(key)
+
+
+@receiver(connection_created)
+def count_connection_queries(sender, connection, **kwargs):
+    profiling.instrument(connection)
@@ -1,25 +1,64 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from django.conf import settings
 from dotenv import load_dotenv
+from typing import Iterator, List
+import json
 import os
+import zlib
 
 load_dotenv()
 
-API_KEY = os.environ["TMDB_API_KEY"]
+
+def api_key() -> str:
+    # read on use, so importing the tasks does not need the key
+    return os.environ["TMDB_API_KEY"]
+
+
+def export_date() -> date:
+    # the export of the previous day is the latest complete one
+    return (datetime.now() - timedelta(days=1)).date()
 
 
 def create_raw_movie_query() -> str:
-    date = datetime.now() - timedelta(days=1)
-    date_str = date.strftime("%m_%d_%Y")
-    return f"http://files.tmdb.org/p/exports/movie_ids_{date_str}.json.gz"
+    date_str = export_date().strftime("%m_%d_%Y")
+    return f"{settings.TMDB_EXPORT_URL}/movie_ids_{date_str}.json.gz"
 
 
 def create_movie_query(movie_id: int) -> str:
-    return f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={API_KEY}&language=en-US"
+    return f"{settings.TMDB_API_URL}/movie/{movie_id}?api_key={api_key()}&language=en-US"
 
 
 def create_genres_query() -> str:
-    return f"https://api.themoviedb.org/3/genre/movie/list?api_key={API_KEY}&language=en-US"
+    return f"{settings.TMDB_API_URL}/genre/movie/list?api_key={api_key()}&language=en-US"
 
 
 def create_valid_thumbnail_url(src: str):
-    return f"https://image.tmdb.org/t/p/original/{src}"
+    return f"{settings.TMDB_IMAGE_URL}/{src}"
+
+
+class NdjsonStreamDecoder:
+    """
+    Incrementally decompresses a gzipped NDJSON stream. Chunks are fed
+    as they arrive and only the complete lines are parsed, so memory
+    use is bounded by the chunk and line size, not the export size.
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b""
+
+    def feed(self, chunk: bytes) -> Iterator[dict]:
+        self.buffer += self.decompressor.decompress(chunk)
+        *lines, self.buffer = self.buffer.split(b"\n")
+        return self.parse_lines(lines)
+
+    def close(self) -> Iterator[dict]:
+        lines = [self.buffer + self.decompressor.flush()]
+        self.buffer = b""
+        return self.parse_lines(lines)
+
+    @staticmethod
+    def parse_lines(lines: List[bytes]) -> Iterator[dict]:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
@@ -3,17 +3,21 @@ from filmdom.celery import app
 import logging
 from datetime import datetime
 import aiohttp
-import gzip
 import asyncio
-import json
 import logging
+from typing import AsyncIterator, List, Tuple
 from . import task_utils
+from . import cache
+from . import fetcher
+from . import ingestion
+from . import leaderboards
+from . import thumbnails
 from celery.signals import worker_ready
+from celery import group
 from celery.schedules import crontab
 from . import models
 from asgiref.sync import sync_to_async
-from django.db.models import Q
-from django.db.utils import IntegrityError
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -24,6 +28,9 @@ file_handler.setFormatter(
 )
 logger.addHandler(file_handler)
 
+# bytes of the compressed export read at once
+EXPORT_CHUNK_SIZE = 64 * 1024
+
 
 @app.on_after_finalize.connect
 def setup_periodic_task(sender, **kwargs):
@@ -32,6 +39,16 @@ def setup_periodic_task(sender, **kwargs):
         fetch_movie_data.s(),
         name="fetch movie data",
     )
+    sender.add_periodic_task(
+        settings.LEADERBOARD_REFRESH_INTERVAL,
+        refresh_leaderboards.s(),
+        name="refresh leaderboards",
+    )
+    sender.add_periodic_task(
+        settings.THUMBNAIL_REFRESH_INTERVAL,
+        create_thumbnail_variants.s(),
+        name="create thumbnail variants",
+    )
 
 
 @worker_ready.connect
@@ -41,142 +58,265 @@ def at_start(sender, **kwargs):
 
 @app.task
 def fetch_movie_data():
+    """
+    Finds the new export entries and fans them out in chunks,
+    every chunk is fetched by its own `fetch_movie_chunk` task
+    """
     logger.debug("Started task: fetching movie data from TMDM API")
-    asyncio.run(start_data_fetch())
-    logger.debug("TMDB Celery task has finished with success")
+    run_id, entries = asyncio.run(prepare_data_fetch())
+    size = settings.TMDB_CHUNK_SIZE
+    chunks = [entries[i : i + size] for i in range(0, len(entries), size)]
+    done = ingestion.add_chunks(run_id, len(chunks))
 
+    if not chunks:
+        if done:
+            finish_data_fetch(run_id)
+        return
 
-def decompress_request(data: bytes) -> str:
-    logger.debug("Decompressing recieved data")
-    return gzip.decompress(data).decode("utf-8")
+    group(fetch_movie_chunk.s(run_id, chunk) for chunk in chunks)()
+    logger.debug(f"TMDB Celery task dispatched {len(chunks)} chunks")
 
 
-def request_to_python_obj(data: str) -> list:
-    logger.debug("Parsing raw string data into python object")
-    data = "[" + data.replace("\n", ",")[:-1] + "]"
-    return json.loads(data)
+@app.task
+def fetch_movie_chunk(run_id: int, entries: List[Tuple[int, str]]):
+    failed = len(entries)
 
+    try:
+        # each chunk runs in its own event loop with its own session
+        stats = asyncio.run(fetch_movies(run_id, entries, workers=True))
+        failed = stats["failed"]
+    finally:
+        # the last finished chunk closes the run, a crashed one counts
+        # all its entries as failed
+        if ingestion.record_chunk(run_id, failed):
+            finish_data_fetch(run_id)
 
-async def check_if_movie_taken(movie_title: str) -> bool:
-    return await sync_to_async(
-        models.Movie.objects.filter(title=movie_title).exists
-    )()
 
+@app.task
+def refresh_leaderboards(force: bool = False):
+    refreshed = leaderboards.refresh(force=force)
 
-async def check_if_genre_taken(genre_name: str, genre_id: int) -> bool:
-    genre = await sync_to_async(
-        models.MovieGenre.objects.filter(id=genre_id, name=genre_name).first
-    )()
+    if refreshed:
+        logger.info(f"Refreshed leaderboards: {', '.join(refreshed)}")
 
-    if genre is not None:
-        logger.debug(
-            "Genre with given params already in database. No operations."
-        )
-        return True
 
-    await sync_to_async(
-        models.MovieGenre.objects.filter(Q(id=genre_id) | Q(name=genre_name))
-        .all()
-        .delete
-    )()
-    logger.debug(
-        "Deleting old entries possessing id or name of the new object"
+@app.task
+def create_thumbnail_variants():
+    stats = asyncio.run(
+        thumbnails.create_pending_variants(settings.THUMBNAIL_BATCH_SIZE)
     )
-    return False
+
+    if stats["succeeded"] or stats["failed"]:
+        logger.info(
+            f"Thumbnail variants of {stats['succeeded']} movies created, "
+            f"{stats['failed']} failed"
+        )
+
+
+async def stream_export_entries(
+    response: aiohttp.ClientResponse,
+) -> AsyncIterator[dict]:
+    logger.debug("Streaming the daily export")
+    decoder = task_utils.NdjsonStreamDecoder()
+
+    async for chunk in response.content.iter_chunked(EXPORT_CHUNK_SIZE):
+        for entry in decoder.feed(chunk):
+            yield entry
+
+    for entry in decoder.close():
+        yield entry
 
 
 async def fetch_one_movie(
-    session: aiohttp.ClientSession, movie_id: int, movie_title: str
+    session: aiohttp.ClientSession,
+    bucket: fetcher.TokenBucket,
+    writer: ingestion.MovieWriter,
+    movie_id: int,
+    movie_title: str,
 ):
-    if await check_if_movie_taken(movie_title):
-        logger.debug(
-            f"Tried to add existing movie: {movie_title}. Operation ignored"
-        )
-        return
     logger.debug(
         f"Movie {movie_title} not present in database. Fetching missing data from the TMBD API"
     )
-    movie_data = await session.get(task_utils.create_movie_query(movie_id))
-    movie_data = await movie_data.json()
-    assert movie_data["original_title"] == movie_title, (
-        f"User tried to add wrong movie!! Requested for "
-        f"{movie_title} and server got {movie_data['original_title']}"
-    )
+    try:
+        movie_data = await fetcher.get_json(
+            session, task_utils.create_movie_query(movie_id), bucket
+        )
+    except fetcher.FetchError as e:
+        # e.g. removed since the export, other errors are retried by
+        # the next run
+        if not e.permanent:
+            raise
+
+        logger.info(f"Movie {movie_id} could not be fetched: {e}")
+        writer.skip(movie_id, "not found")
+        return
+
+    if movie_data["original_title"] != movie_title:
+        logger.info(
+            f"User tried to add wrong movie!! Requested for "
+            f"{movie_title} and server got {movie_data['original_title']}"
+        )
+        return
+
     logger.debug(f"Adding movie {movie_title} to the database")
 
     if not movie_data["release_date"]:
         logger.info(f"Fetcher movie with bad date format: {movie_data}")
+        writer.skip(movie_id, "no release date")
         return
 
-    try:
-        movie = await sync_to_async(models.Movie.objects.create)(
-            title=movie_data["original_title"],
-            produce_date=movie_data["release_date"],
-            remote_thumbnail=task_utils.create_valid_thumbnail_url(
-                movie_data["poster_path"]
-            ),
-            text=movie_data["overview"],
-        )
-    except IntegrityError:
-        logger.debug(
-            "Tried to add movie with exact "
-            "same title. Ignored operation to save the fetching process"
-        )
-        return
+    movie = models.Movie(
+        tmdb_id=movie_id,
+        title=movie_data["original_title"],
+        produce_date=movie_data["release_date"],
+        remote_thumbnail=task_utils.create_valid_thumbnail_url(
+            movie_data["poster_path"]
+        ),
+        text=movie_data["overview"],
+    )
+    await writer.add(movie, [el["id"] for el in movie_data["genres"]])
+
+
+async def limit_entries(
+    entries: AsyncIterator[dict], limit: int
+) -> AsyncIterator[dict]:
+    count = 0
+    async for entry in entries:
+        if count >= limit:
+            return
+        count += 1
+        yield entry
+
+
+async def find_new_entries(
+    session: aiohttp.ClientSession,
+) -> List[Tuple[int, str]]:
+    """
+    Diffs the export against the imported and skipped TMDB ids,
+    which also resumes an interrupted run
+    """
+    # the export is big, only stalled reads should time out
+    raw_data = await session.get(
+        task_utils.create_raw_movie_query(),
+        read_until_eof=True,
+        timeout=aiohttp.ClientTimeout(
+            total=None, sock_read=settings.TMDB_REQUEST_TIMEOUT
+        ),
+    )
+    known_ids = await sync_to_async(ingestion.load_known_ids)()
+
+    async def new_entries():
+        async for movie_entry in stream_export_entries(raw_data):
+            if movie_entry["id"] not in known_ids:
+                yield movie_entry
 
-    await sync_to_async(movie.genres.set)(
-        await sync_to_async(models.MovieGenre.objects.filter)(
-            id__in=[el["id"] for el in movie_data["genres"]]
+    # the rest of the new entries is left for the next run
+    entries = [
+        (movie_entry["id"], movie_entry["original_title"])
+        async for movie_entry in limit_entries(
+            new_entries(), settings.TMDB_MAX_MOVIES_PER_RUN
         )
+    ]
+    raw_data.close()
+    return entries
+
+
+async def fetch_all_movies(
+    session: aiohttp.ClientSession,
+    bucket: fetcher.TokenBucket,
+    run_id: int,
+    entries: List[Tuple[int, str]],
+) -> dict:
+    writer = ingestion.MovieWriter(
+        settings.TMDB_WRITE_BATCH_SIZE,
+        await sync_to_async(ingestion.load_genre_ids)(),
+        run_id,
     )
 
+    async def all_entries():
+        for entry in entries:
+            yield entry
 
-async def fetch_all_movies(session: aiohttp.ClientSession):
-    raw_data = await session.get(
-        task_utils.create_raw_movie_query(), read_until_eof=True
+    async def fetch_entry(entry: Tuple[int, str]):
+        await fetch_one_movie(session, bucket, writer, *entry)
+
+    stats = await fetcher.run_bounded(
+        all_entries(), fetch_entry, settings.TMDB_CONCURRENCY
     )
-    movie_data = request_to_python_obj(
-        decompress_request(await raw_data.content.read())
+    await writer.flush()
+    logger.info(
+        f"Movie fetching process has finished! {stats}, "
+        f"saved movies: {writer.written}"
+    )
+    return stats
+
+
+async def fetch_all_genres(
+    session: aiohttp.ClientSession, bucket: fetcher.TokenBucket
+):
+    logger.info("Fetching genre data")
+    query = task_utils.create_genres_query()
+    genre_list = (await fetcher.get_json(session, query, bucket))["genres"]
+    stats = await sync_to_async(ingestion.sync_genres)(genre_list)
+    logger.info(f"Genres synchronized: {stats}")
+
+
+def create_bucket(workers: bool = False) -> fetcher.TokenBucket:
+    rate = settings.TMDB_REQUESTS_PER_SECOND
+
+    # chunk tasks running in parallel share the request budget
+    if workers:
+        rate /= settings.TMDB_INGESTION_WORKERS
+
+    return fetcher.TokenBucket(rate)
+
+
+async def prepare_data_fetch() -> Tuple[int, List[Tuple[int, str]]]:
+    bucket = create_bucket()
+
+    async with fetcher.create_session() as client:
+        # this is cheap. We allow blocking
+        await fetch_all_genres(client, bucket)
+        entries = await find_new_entries(client)
+
+    run = await sync_to_async(ingestion.start_run)(
+        task_utils.export_date(), len(entries)
     )
-    movie_tasks = []
-
-    # limiting for test purposes
-    for movie_entry in movie_data[:10_000]:
-        movie_tasks.append(
-            fetch_one_movie(
-                session, movie_entry["id"], movie_entry["original_title"]
-            )
+    return run.id, entries
+
+
+async def fetch_movies(
+    run_id: int, entries: List[Tuple[int, str]], workers: bool = False
+) -> dict:
+    async with fetcher.create_session() as client:
+        return await fetch_all_movies(
+            client, create_bucket(workers), run_id, entries
         )
 
-    # very expensive!!
-    await asyncio.gather(*movie_tasks)
-    logger.info("Movie fetching process has finished!")
 
+def finish_data_fetch(run_id: int):
+    run = ingestion.finish_run(run_id)
 
-async def fetch_all_genres(session: aiohttp.ClientSession):
-    logger.info("Fetching genre data")
-    genres = await session.get(task_utils.create_genres_query())
-    assert genres.status == 200, "could not get movie genres"
-    genre_list = (await genres.json())["genres"]
-    for g in genre_list:
-        if not await check_if_genre_taken(g["name"], g["id"]):
-            logger.debug(
-                f"Genre with name: {g['name']} not present in the "
-                "database. Creating new entry."
-            )
-            await (
-                sync_to_async(models.MovieGenre.objects.create)(
-                    name=g["name"], id=g["id"]
-                )
-            )
-        else:
-            logger.debug(f"Genre with name: {g['name']} already exists")
+    # cached catalog responses are outdated after the import
+    cache.bump_versions("movies", "genres")
+    leaderboards.mark_dirty()
+    logger.info(
+        f"Import of the {run.export_date} export has finished. "
+        f"Requested: {run.requested}, saved: {run.saved}, "
+        f"skipped: {run.skipped}, failed: {run.failed}, "
+        f"took: {run.finished - run.started}"
+    )
 
 
 async def start_data_fetch():
-    async with aiohttp.ClientSession() as client:
-        # this is cheap. We allow blocking
-        genre_task = await fetch_all_genres(client)
+    """
+    Whole import in the current process, without Celery
+    """
+    run_id, entries = await prepare_data_fetch()
+
+    # this is expensive
+    stats = await fetch_movies(run_id, entries)
 
-        # this is expensive
-        movie_task = await fetch_all_movies(client)
+    await sync_to_async(ingestion.add_chunks)(run_id, 1)
+    await sync_to_async(ingestion.record_chunk)(run_id, stats["failed"])
+    await sync_to_async(finish_data_fetch)(run_id)
@@ -5,10 +5,56 @@ from rest_framework.test import (
     APITestCase,
 )
 from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.test import (
+    AsyncClient,
+    RequestFactory,
+    SimpleTestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from io import BytesIO, StringIO
+from urllib.parse import urlencode
 from typing import Tuple, Optional, List
 import random
-from . import random_data
+import gzip
+import json
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+import os
+import shutil
+import tempfile
+import time
+from . import (
+    authentication,
+    cache as response_cache,
+    fake_tmdb,
+    fetcher,
+    ingestion,
+    leaderboards,
+    profiling,
+    random_data,
+    replicas,
+    search,
+    task_utils,
+    tasks,
+    thumbnails,
+    views,
+)
+from .pagination import KeysetPagination
 from secrets import token_urlsafe
+from unittest import mock
+from datetime import date, timedelta
+from django.core.cache import cache
 
 # creating dummy server
 client = APIClient()
@@ -474,6 +520,49 @@ class MovieDataTest(APITestCase):
         self.assertEqual(res.status_code, status.HTTP_200_OK, res.content)
         self.assertEqual(len(res.json()["results"]), 3, res.json()["results"])
 
+    def test_movie_random_seed(self):
+        for i in range(10):
+            create_movie(f"random movie no.:{i}")
+        create_movie("other title")
+
+        data = {"sort_method": "random", "seed": "42", "limit": 100}
+        first = [m["id"] for m in client.get("/movies/", data=data).json()]
+        second = [m["id"] for m in client.get("/movies/", data=data).json()]
+        self.assertEqual(first, second)
+        self.assertCountEqual(
+            first, models.Movie.objects.values_list("id", flat=True)
+        )
+
+        # an affine permutation would put consecutive ids at most three
+        # distinct distances apart
+        position = {movie_id: i for i, movie_id in enumerate(first)}
+        ids = sorted(position)
+        gaps = {
+            (position[b] - position[a]) % len(ids)
+            for a, b in zip(ids, ids[1:])
+        }
+        self.assertGreater(len(gaps), 3, first)
+
+        # pages of the same shuffle do not overlap
+        data = {"sort_method": "random", "seed": "42"}
+        pages = [
+            m["id"]
+            for page in (1, 2)
+            for m in client.get(
+                "/movies/", data=dict(data, page=page)
+            ).json()["results"]
+        ]
+        self.assertEqual(pages, first[:12])
+
+        res = client.get(
+            "/movies/",
+            data={"sort_method": "random", "title_like": "random", "limit": 3},
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK, res.content)
+        self.assertEqual(len(res.json()), 3, res.json())
+        for movie in res.json():
+            self.assertIn("random", movie["title"])
+
     def test_movie_title_subseq(self):
         m1 = create_movie("0000movie000")
         m2 = create_movie("aaaaaaa")
@@ -602,6 +691,37 @@ class CommentTest(APITestCase):
         self.assertEqual(res.status_code, status.HTTP_200_OK, res.content)
         self.assertEqual(20, len(res.json()), res.json())
 
+    def test_query_count(self):
+        m1 = create_movie("movie1")
+        m2 = create_movie("movie2")
+        alice, _ = create_dummy_user("alice")
+        bob, _ = create_dummy_user("bob")
+        create_comments(m1, alice, 1, 2, 3, 4)
+        create_comments(m2, bob, 1, 2, 3, 4)
+
+        for data in (
+            {},
+            {"sort_method": "newest"},
+            {"movie_id": m1.id, "sort_method": "newest"},
+            {"user": bob.username},
+            {"title_like": "movie"},
+        ):
+            with self.subTest(**data):
+                # count + select, creators and movies are joined
+                with self.assertNumQueries(2):
+                    res = client.get("/comments/", data=data)
+                self.assertEqual(
+                    res.status_code, status.HTTP_200_OK, res.content
+                )
+
+        with self.assertNumQueries(1):
+            res = client.get(
+                "/comments/", data={"sort_method": "newest", "limit": 3}
+            )
+        self.assertEqual(
+            [c["rating"] for c in res.json()], [4, 3, 2], res.json()
+        )
+
 
 class DataflowTest(APITestCase):
     """
@@ -627,3 +747,1415 @@ class DataflowTest(APITestCase):
         m1.delete()
         n_comments = models.Comment.objects.count()
         self.assertEqual(0, n_comments, f"Ori: {n_comments} | should be 0")
+
+
+class RatingAggregateTest(APITestCase):
+    """
+    Testing if the denormalized rating columns of
+    a movie follow the changes of its comments
+    """
+
+    def assertRating(self, movie, rating_sum, rating_count, average):
+        movie.refresh_from_db()
+        self.assertEqual(movie.rating_sum, rating_sum)
+        self.assertEqual(movie.rating_count, rating_count)
+        self.assertEqual(movie.average_rating, average)
+        self.assertEqual(sum(movie.rating_histogram().values()), rating_count)
+
+    def assertHistogram(self, movie, **counts):
+        movie.refresh_from_db()
+        expected = {bucket: 0 for bucket in models.RATING_BUCKETS}
+        expected.update({int(name[1:]): n for name, n in counts.items()})
+        self.assertEqual(movie.rating_histogram(), expected)
+
+    def test_comment_lifecycle(self):
+        alice, _ = create_dummy_user("alice")
+        m1 = create_movie("movie1")
+        m2 = create_movie("movie2")
+        self.assertRating(m1, 0, 0, None)
+
+        c1, c2 = create_comments(m1, alice, 4, 2)
+        self.assertRating(m1, 6, 2, 3)
+        self.assertHistogram(m1, r2=1, r4=1)
+
+        c1.rating = 5
+        c1.save()
+        self.assertRating(m1, 7, 2, 3.5)
+        self.assertHistogram(m1, r2=1, r5=1)
+
+        c2.commented_movie = m2
+        c2.save()
+        self.assertRating(m1, 5, 1, 5)
+        self.assertRating(m2, 2, 1, 2)
+        self.assertHistogram(m2, r2=1)
+
+        c2.rating = 2.5
+        c2.save()
+        self.assertHistogram(m2, r2=1)
+
+        c1.delete()
+        self.assertRating(m1, 0, 0, None)
+        self.assertHistogram(m1)
+
+        alice.delete()
+        self.assertRating(m2, 0, 0, None)
+
+    def test_rebuild_ratings(self):
+        alice, _ = create_dummy_user("alice")
+        movie = create_movie("movie1")
+        create_comments(movie, alice, 1, 2, 3, 3.5, 5, 0)
+        models.Movie.objects.update(
+            rating_sum=0, rating_count=0, average_rating=None, rating_count_3=9
+        )
+
+        call_command("rebuild_ratings", stdout=StringIO())
+        self.assertRating(movie, 14.5, 6, 14.5 / 6)
+        self.assertHistogram(movie, r0=1, r1=1, r2=1, r3=2, r5=1)
+
+    def test_histogram_field(self):
+        alice, _ = create_dummy_user("alice")
+        movie = create_movie("movie1")
+        create_comments(movie, alice, 1, 4, 4.5)
+        histogram = {"0": 0, "1": 1, "2": 0, "3": 0, "4": 2, "5": 0}
+
+        res = client.get(f"/movies/{movie.id}/")
+        self.assertEqual(res.json()["rating_histogram"], histogram)
+
+        # lists only have it on request
+        res = client.get("/movies/")
+        self.assertNotIn("rating_histogram", res.json()["results"][0])
+        res = client.get("/movies/", data={"fields": "id,rating_histogram"})
+        self.assertEqual(
+            res.json()["results"][0],
+            {"id": movie.id, "rating_histogram": histogram},
+        )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0, LEADERBOARD_STATE_TTL=3600)
+class MovieQueryCountTest(APITestCase):
+    """
+    Serializing a page of movies has to cost a fixed number
+    of queries, no matter how many movies are on the page
+    """
+
+    def setUp(self):
+        # the board states are loaded once per process, not per page
+        leaderboards.board_states.get("best")
+        self.addCleanup(leaderboards.board_states.clear)
+
+    sort_methods = [
+        None,
+        "best",
+        "worst",
+        "most_popular",
+        "least_popular",
+        "newest",
+        "oldest",
+        "random",
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        alice = User.objects.create_user("alice", "ali@ce.com", "alicepass")
+        for i in range(8):
+            movie = create_movie(f"query count movie no.:{i}")
+            create_comments(movie, alice, i % 5, 5)
+
+    def test_list_query_count(self):
+        # compact lists need no relations: count + select
+        for representation, queries in (("compact", 2), ("full", 4)):
+            for sort_method in self.sort_methods:
+                data = {"representation": representation}
+                if sort_method is not None:
+                    data["sort_method"] = sort_method
+
+                with self.subTest(sort_method=sort_method, data=data):
+                    # count + select + genres prefetch + actors prefetch
+                    with self.assertNumQueries(queries):
+                        res = client.get("/movies/", data=data)
+                    self.assertEqual(res.status_code, status.HTTP_200_OK)
+                    self.assertEqual(len(res.json()["results"]), 6)
+
+    def test_limit_query_count(self):
+        for representation, queries in (("compact", 1), ("full", 3)):
+            for sort_method in self.sort_methods:
+                data = {"limit": 8, "representation": representation}
+                if sort_method is not None:
+                    data["sort_method"] = sort_method
+
+                with self.subTest(sort_method=sort_method, data=data):
+                    # no pagination means there is no count query either
+                    with self.assertNumQueries(queries):
+                        res = client.get("/movies/", data=data)
+                    self.assertEqual(res.status_code, status.HTTP_200_OK)
+                    self.assertEqual(len(res.json()), 8)
+
+    def test_detail_query_count(self):
+        movie = models.Movie.objects.first()
+        with self.assertNumQueries(3):
+            res = client.get(f"/movies/{movie.id}/")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+
+class KeysetPaginationTest(APITestCase):
+    """
+    Walking all the cursor pages has to give the same
+    sequence as the unpaginated listing, ties included
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        alice = User.objects.create_user("alice", "ali@ce.com", "alicepass")
+        for i in range(13):
+            movie = create_movie(
+                f"cursor movie no.:{i}", produce_date=f"200{i % 3}-01-01"
+            )
+            create_comments(movie, alice, *([i % 4] * (i % 3)))
+
+    def walk_pages(self, url, data):
+        data = dict(data, pagination="cursor", limit=4)
+        results = []
+
+        while url is not None:
+            res = client.get(url, data=data)
+            self.assertEqual(res.status_code, status.HTTP_200_OK, res.content)
+            self.assertNotIn("count", res.json())
+            self.assertLessEqual(len(res.json()["results"]), 4)
+            results.extend(res.json()["results"])
+            url, data = res.json()["next"], None
+
+        return results
+
+    def test_movie_pages(self):
+        for sort_method in (
+            "title",
+            "best",
+            "worst",
+            "most_popular",
+            "least_popular",
+            "newest",
+            "oldest",
+            "random",
+        ):
+            data = {"sort_method": sort_method, "seed": 7}
+            with self.subTest(sort_method=sort_method):
+                expected = client.get(
+                    "/movies/", data=dict(data, limit=100)
+                ).json()
+                results = self.walk_pages("/movies/", data)
+                self.assertEqual(
+                    [m["id"] for m in results], [m["id"] for m in expected]
+                )
+
+    def test_comment_pages(self):
+        for sort_method in ("newest", "oldest"):
+            with self.subTest(sort_method=sort_method):
+                expected = client.get(
+                    "/comments/",
+                    data={"sort_method": sort_method, "limit": 100},
+                ).json()
+                results = self.walk_pages(
+                    "/comments/", {"sort_method": sort_method}
+                )
+                self.assertEqual(
+                    [c["id"] for c in results], [c["id"] for c in expected]
+                )
+
+    def test_invalid_cursor(self):
+        res = client.get("/movies/", data={"cursor": "not a cursor"})
+        self.assertEqual(
+            res.status_code, status.HTTP_404_NOT_FOUND, res.content
+        )
+
+        # well formed cursors with values of the wrong type
+        for sort_method, position in (
+            ("best", ["x", "y"]),
+            ("newest", ["notadate", 1]),
+            (None, [{"a": 1}]),
+            ("most_popular", [[1], 2]),
+        ):
+            with self.subTest(sort_method=sort_method, position=position):
+                data = {"cursor": KeysetPagination.encode_cursor(position)}
+                if sort_method is not None:
+                    data["sort_method"] = sort_method
+                res = client.get("/movies/", data=data)
+                self.assertEqual(
+                    res.status_code, status.HTTP_404_NOT_FOUND, res.content
+                )
+
+
+class TitleSearchTest(APITestCase):
+    def search(self, text, **data):
+        res = client.get(
+            "/movies/", data=dict(data, title_like=text, limit=100)
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK, res.content)
+        return [m["title"] for m in res.json()]
+
+    def test_index_follows_titles(self):
+        movie = create_movie("The Matrix")
+        create_movie("Matrix Reloaded")
+        create_movie("Gladiator")
+
+        self.assertCountEqual(
+            self.search("MATRIX"), ["The Matrix", "Matrix Reloaded"]
+        )
+        self.assertEqual(self.search("atrix rel"), ["Matrix Reloaded"])
+        # too short for a trigram, falls back to a plain scan
+        self.assertEqual(len(self.search("a")), 3)
+
+        # other create_movie calls may have replaced its director
+        movie.refresh_from_db()
+        movie.title = "The Godfather"
+        movie.save()
+        self.assertEqual(self.search("matrix"), ["Matrix Reloaded"])
+        self.assertEqual(self.search("godfather"), ["The Godfather"])
+        self.assertEqual(
+            models.MovieTitleGram.objects.filter(movie=movie).count(),
+            len(search.title_grams(movie.title)),
+        )
+
+    def test_relevance(self):
+        create_movie("Alien vs Predator")
+        create_movie("Aliens")
+        create_movie("Alien")
+        create_movie("The Alien Within")
+
+        self.assertEqual(
+            self.search("alien", sort_method="relevance"),
+            ["Alien", "Aliens", "Alien vs Predator", "The Alien Within"],
+        )
+
+    def test_rebuild_index(self):
+        create_movie("The Matrix")
+        models.MovieTitleGram.objects.all().delete()
+        self.assertEqual(self.search("matrix"), [])
+
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.search("matrix"), ["The Matrix"])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=15 * 60)
+class ResponseCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_until_changed(self):
+        alice, _ = create_dummy_user("alice")
+        movie = create_movie("movie1")
+        data = {"sort_method": "best"}
+
+        client.get("/movies/", data=data)
+        with self.assertNumQueries(0):
+            res = client.get("/movies/", data=data)
+        self.assertEqual(res.json()["results"][0]["average_rating"], None)
+
+        client.get(f"/movies/{movie.id}/")
+        with self.assertNumQueries(0):
+            client.get(f"/movies/{movie.id}/")
+
+        # comments change the ratings in lists and details, once
+        # they are committed
+        with self.captureOnCommitCallbacks(execute=True):
+            create_comments(movie, alice, 4)
+        res = client.get("/movies/", data=data)
+        self.assertEqual(res.json()["results"][0]["average_rating"], 4)
+        res = client.get(f"/movies/{movie.id}/")
+        self.assertEqual(res.json()["average_rating"], 4)
+
+        # other parameters are cached separately
+        with self.assertNumQueries(1):
+            res = client.get("/movies/", data={"limit": 1})
+        self.assertEqual(len(res.json()), 1)
+
+    def test_catalog_lists(self):
+        models.MovieGenre.objects.create(name="drama")
+        client.get("/genres/")
+        with self.assertNumQueries(0):
+            res = client.get("/genres/")
+        self.assertEqual(len(res.json()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            models.MovieGenre.objects.create(name="horror")
+            res = client.get("/genres/")
+            self.assertEqual(len(res.json()), 1)
+        self.assertEqual(len(callbacks), 1)
+
+        res = client.get("/genres/")
+        self.assertEqual(len(res.json()), 2)
+
+    def test_unseeded_random_is_not_cached(self):
+        create_movie("movie1")
+        client.get("/movies/", data={"sort_method": "random"})
+        with self.assertNumQueries(2):
+            client.get("/movies/", data={"sort_method": "random"})
+
+    def test_local_cache_warning(self):
+        warnings = response_cache.check_shared_cache(None)
+        self.assertEqual([w.id for w in warnings], ["filmdom_mvp.W001"])
+
+        with self.settings(CATALOG_CACHE_TIMEOUT=0):
+            self.assertEqual(response_cache.check_shared_cache(None), [])
+
+
+class ExportDecoderTest(SimpleTestCase):
+    def test_chunked_export(self):
+        entries = [
+            {"id": i, "original_title": f"movie {i}", "popularity": i / 3}
+            for i in range(500)
+        ]
+        payload = gzip.compress(
+            "\n".join(json.dumps(e) for e in entries).encode("utf-8") + b"\n"
+        )
+
+        decoder = task_utils.NdjsonStreamDecoder()
+        decoded = []
+        for i in range(0, len(payload), 7):
+            decoded.extend(decoder.feed(payload[i : i + 7]))
+        decoded.extend(decoder.close())
+
+        self.assertEqual(decoded, entries)
+
+
+@override_settings(TMDB_RETRY_BACKOFF=0, TMDB_MAX_RETRIES=2)
+class FetcherTest(SimpleTestCase):
+    def test_bounded_workers(self):
+        in_flight = []
+        peak = []
+
+        async def entries():
+            for i in range(50):
+                yield i
+
+        async def worker(item):
+            in_flight.append(item)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0)
+            in_flight.remove(item)
+            if item % 10 == 0:
+                raise ValueError("broken entry")
+
+        with self.assertLogs(fetcher.logger, "ERROR"):
+            stats = asyncio.run(fetcher.run_bounded(entries(), worker, 4))
+        self.assertEqual(stats, {"succeeded": 45, "failed": 5})
+        self.assertLessEqual(max(peak), 4)
+
+    def test_retries(self):
+        calls = []
+
+        async def flaky(request):
+            calls.append(request.path)
+            if len(calls) < 3:
+                return web.Response(status=503)
+            return web.json_response({"ok": True})
+
+        async def broken(request):
+            calls.append(request.path)
+            return web.Response(status=404)
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/flaky", flaky)
+            app.router.add_get("/broken", broken)
+            bucket = fetcher.TokenBucket(1000)
+
+            async with TestServer(app) as server:
+                async with fetcher.create_session() as session:
+                    data = await fetcher.get_json(
+                        session, str(server.make_url("/flaky")), bucket
+                    )
+                    self.assertEqual(data, {"ok": True})
+
+                    with self.assertRaises(fetcher.FetchError) as error:
+                        await fetcher.get_json(
+                            session, str(server.make_url("/broken")), bucket
+                        )
+                    self.assertTrue(error.exception.permanent)
+
+        asyncio.run(run())
+        # 404 is not retried
+        self.assertEqual(calls, ["/flaky"] * 3 + ["/broken"])
+
+
+class IngestionWriteTest(APITestCase):
+    def test_batch_write(self):
+        drama = models.MovieGenre.objects.create(name="drama")
+        horror = models.MovieGenre.objects.create(name="horror")
+        legacy = create_movie("legacy title")
+        imported = create_movie("imported title")
+        imported.tmdb_id = 999
+        imported.save()
+        run = ingestion.start_run(date(2021, 8, 1))
+
+        batch = [
+            (
+                models.Movie(
+                    tmdb_id=i,
+                    title=f"fetched {i}",
+                    produce_date="2001-01-01",
+                ),
+                [drama.id, horror.id] if i % 2 else [drama.id],
+            )
+            for i in range(20)
+        ]
+        for tmdb_id, title in ((500, "legacy title"), (600, "imported title")):
+            batch.append(
+                (
+                    models.Movie(
+                        tmdb_id=tmdb_id, title=title, produce_date="2001-01-01"
+                    ),
+                    [],
+                )
+            )
+
+        with CaptureQueriesContext(connection) as queries:
+            written = ingestion.write_movies(
+                batch, [(700, "no release date")], run.id
+            )
+
+        # taken titles, insert, ids, genre links, title index delete and
+        # insert, legacy movies select and update, skipped entries insert
+        # and the run progress, savepoints aside
+        self.assertEqual(
+            len(
+                [q for q in queries if "SAVEPOINT" not in q["sql"].upper()]
+            ),
+            10,
+        )
+        self.assertEqual(written, 20)
+        self.assertEqual(drama.movie_set.count(), 20)
+        self.assertEqual(horror.movie_set.count(), 10)
+        self.assertEqual(
+            models.Movie.objects.get(title="fetched 3").rating_count, 0
+        )
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.tmdb_id, 500)
+
+        run.refresh_from_db()
+        self.assertEqual((run.saved, run.skipped), (20, 2))
+        self.assertEqual(
+            ingestion.load_known_ids(), {*range(20), 500, 600, 700, 999}
+        )
+
+        res = client.get(
+            "/movies/", data={"title_like": "fetched 1", "limit": 100}
+        )
+        self.assertEqual(len(res.json()), 11, res.json())
+
+    def test_run_chunks(self):
+        run = ingestion.start_run(date(2021, 8, 1), 30)
+        self.assertFalse(ingestion.add_chunks(run.id, 3))
+
+        self.assertFalse(ingestion.record_chunk(run.id, 0))
+        self.assertFalse(ingestion.record_chunk(run.id, 2))
+
+        # resuming the run while a chunk is still running reopens it,
+        # the chunk counts towards it
+        ingestion.start_run(date(2021, 8, 1), 5)
+        self.assertFalse(ingestion.add_chunks(run.id, 1))
+        self.assertFalse(ingestion.record_chunk(run.id, 1))
+        self.assertTrue(ingestion.record_chunk(run.id, 1))
+
+        run = ingestion.finish_run(run.id)
+        self.assertEqual((run.requested, run.failed), (35, 4))
+        self.assertEqual((run.chunks, run.completed_chunks), (4, 4))
+        self.assertIsNotNone(run.finished)
+
+        ingestion.start_run(date(2021, 8, 1))
+        run.refresh_from_db()
+        self.assertIsNone(run.finished)
+        self.assertTrue(ingestion.add_chunks(run.id, 0))
+
+    def test_crashed_chunk(self):
+        run = ingestion.start_run(date(2021, 8, 1), 3)
+        ingestion.add_chunks(run.id, 1)
+        entries = [(i, f"movie {i}") for i in range(3)]
+
+        with mock.patch.object(
+            tasks, "fetch_movies", side_effect=RuntimeError("crashed")
+        ):
+            with self.assertRaises(RuntimeError):
+                tasks.fetch_movie_chunk(run.id, entries)
+
+        run.refresh_from_db()
+        self.assertEqual((run.completed_chunks, run.failed), (1, 3))
+        self.assertIsNotNone(run.finished)
+
+    def test_sync_genres(self):
+        movie = create_movie("genre sync movie")
+        models.MovieGenre.objects.all().delete()
+        models.MovieGenre.objects.create(id=1, name="Action")
+        models.MovieGenre.objects.create(id=2, name="Comedy")
+        models.MovieGenre.objects.create(id=3, name="Drama")
+        models.MovieGenre.objects.create(id=50, name="Horror")
+        local = models.MovieGenre.objects.create(id=60, name="Local")
+        movie.genres.set([1, 50, local])
+
+        remote = [
+            {"id": 1, "name": "Action"},
+            {"id": 2, "name": "Drama"},
+            {"id": 3, "name": "Comedy"},
+            {"id": 27, "name": "Horror"},
+            {"id": 99, "name": "Documentary"},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            stats = ingestion.sync_genres(remote)
+
+        self.assertEqual(stats, {"created": 2, "renamed": 2, "deleted": 1})
+        self.assertLessEqual(
+            len([q for q in queries if "SAVEPOINT" not in q["sql"].upper()]),
+            10,
+        )
+        self.assertEqual(
+            dict(models.MovieGenre.objects.values_list("id", "name")),
+            {**{g["id"]: g["name"] for g in remote}, 60: "Local"},
+        )
+        # links of the kept and replaced genres survive
+        self.assertEqual(
+            set(movie.genres.values_list("id", flat=True)), {1, 27, 60}
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            stats = ingestion.sync_genres(remote)
+        self.assertEqual(stats, {"created": 0, "renamed": 0, "deleted": 0})
+
+
+@override_settings(
+    TMDB_RETRY_BACKOFF=0, TMDB_REQUESTS_PER_SECOND=1000, TMDB_CHUNK_SIZE=7
+)
+class FakeTmdbIngestionTest(TransactionTestCase):
+    def test_full_import(self):
+        # the ORM runs in other threads, a test transaction would hide
+        # the rows from them
+        app = fake_tmdb.create_app(movies=120, error_rate=0.05, seed=1)
+
+        async def run():
+            runner = await fake_tmdb.start_server(app)
+            url = fake_tmdb.server_url(runner)
+            try:
+                with override_settings(
+                    TMDB_API_URL=f"{url}/3",
+                    TMDB_EXPORT_URL=f"{url}/p/exports",
+                ):
+                    await tasks.start_data_fetch()
+            finally:
+                await runner.cleanup()
+
+        with mock.patch.dict("os.environ", {"TMDB_API_KEY": "fake"}):
+            asyncio.run(run())
+
+        self.assertEqual(models.MovieGenre.objects.count(), 8)
+        # 2 undated and 3 missing movies are skipped
+        self.assertEqual(models.Movie.objects.count(), 120 - 5)
+        self.assertEqual(
+            dict(
+                models.SkippedTmdbEntry.objects.values_list(
+                    "tmdb_id", "reason"
+                )
+            ),
+            {
+                50: "no release date",
+                100: "no release date",
+                40: "not found",
+                80: "not found",
+                120: "not found",
+            },
+        )
+        run = models.IngestionRun.objects.get()
+        self.assertEqual(
+            (run.requested, run.saved, run.skipped, run.failed),
+            (120, 115, 5, 0),
+        )
+        self.assertIsNotNone(run.finished)
+        movie = models.Movie.objects.get(tmdb_id=7)
+        self.assertEqual(movie.title, fake_tmdb.movie_title(7))
+        self.assertEqual(
+            movie.genres.count(), len(fake_tmdb.movie_details(7)["genres"])
+        )
+
+
+def poster(size: Tuple[int, int], mode: str = "RGB") -> bytes:
+    output = BytesIO()
+    Image.new(mode, size, "red").save(output, "PNG")
+    return output.getvalue()
+
+
+class ThumbnailVariantTest(TransactionTestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        # saving a movie reads the size of its default thumbnail
+        shutil.copy(
+            os.path.join(settings.MEDIA_ROOT, thumbnails.DEFAULT_THUMBNAIL),
+            media.name,
+        )
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def test_make_variants(self):
+        variants = thumbnails.make_variants(poster((1000, 1500), "RGBA"))
+
+        self.assertEqual(set(variants), {"grid", "detail"})
+        content, width, height = variants["grid"]
+        self.assertEqual((width, height), (185, 278))
+        with Image.open(BytesIO(content)) as image:
+            self.assertEqual((image.format, image.size), ("JPEG", (185, 278)))
+
+        # small images are not enlarged
+        variants = thumbnails.make_variants(poster((100, 50)))
+        self.assertEqual(variants["detail"][1:], (100, 50))
+
+        with self.assertRaises(thumbnails.ThumbnailError):
+            thumbnails.make_variants(b"not an image")
+
+    @override_settings(TMDB_MAX_RETRIES=0)
+    def test_create_pending_variants(self):
+        # the ORM runs in other threads, a test transaction would hide
+        # the rows from them
+        remote, uploaded, broken, unavailable, _ = [
+            # create_movie drops other movies' people with the same names
+            create_movie(title, None, [], f"director of {title}", [])
+            for title in (
+                "remote",
+                "uploaded",
+                "broken",
+                "unavailable",
+                "no poster",
+            )
+        ]
+        uploaded.thumbnail.save("upload.png", ContentFile(poster((600, 300))))
+
+        async def serve_poster(request):
+            return web.Response(body=poster((2000, 3000)))
+
+        async def fail(request):
+            return web.Response(status=503)
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/poster.png", serve_poster)
+            app.router.add_get("/unavailable.png", fail)
+
+            async with TestServer(app) as server:
+                for movie, path in (
+                    (remote, "/poster.png"),
+                    (broken, "/x"),
+                    (unavailable, "/unavailable.png"),
+                ):
+                    movie.remote_thumbnail = str(server.make_url(path))
+                    await sync_to_async(movie.save)()
+
+                with self.assertLogs(fetcher.logger, "ERROR"):
+                    return await thumbnails.create_pending_variants(10)
+
+        self.assertEqual(asyncio.run(run()), {"succeeded": 2, "failed": 2})
+        # the missing poster is not fetched again, the unavailable one
+        # is after a while
+        unavailable.refresh_from_db()
+        self.assertEqual(unavailable.thumbnail_variants_attempts, 1)
+        self.assertEqual(thumbnails.pending_movies(10), [])
+        later = unavailable.thumbnail_variants_retry_at
+        with mock.patch.object(thumbnails.timezone, "now", return_value=later):
+            self.assertEqual(
+                thumbnails.pending_movies(10),
+                [(unavailable.id, unavailable.remote_thumbnail)],
+            )
+            thumbnails.postpone(unavailable.id)
+        unavailable.refresh_from_db()
+        self.assertEqual(
+            unavailable.thumbnail_variants_retry_at - later,
+            timedelta(seconds=2 * settings.THUMBNAIL_RETRY_BACKOFF),
+        )
+
+        res = client.get(f"/movies/{remote.id}/")
+        grid = res.json()["thumbnail_variants"]["grid"]
+        self.assertEqual((grid["width"], grid["height"]), (185, 278))
+        prefix = "http://testserver" + settings.MEDIA_URL
+        self.assertTrue(grid["url"].startswith(prefix + "thumbnails/"))
+        self.assertTrue(default_storage.exists(grid["url"][len(prefix) :]))
+
+        uploaded.refresh_from_db()
+        detail = uploaded.thumbnail_variants["detail"]
+        self.assertEqual((detail["width"], detail["height"]), (500, 250))
+        broken.refresh_from_db()
+        self.assertEqual(broken.thumbnail_variants, {})
+
+        # another poster is processed again, before the ones that
+        # keep failing
+        broken.remote_thumbnail = "http://localhost/other.png"
+        broken.save()
+        models.Movie.objects.filter(pk=unavailable.pk).update(
+            thumbnail_variants_retry_at=None
+        )
+        self.assertEqual(
+            thumbnails.pending_movies(10),
+            [
+                (broken.id, "http://localhost/other.png"),
+                (unavailable.id, unavailable.remote_thumbnail),
+            ],
+        )
+
+
+class GenerateCatalogTest(APITestCase):
+    def test_generate_catalog(self):
+        call_command(
+            "generate_catalog",
+            movies=200,
+            actors=50,
+            directors=10,
+            users=40,
+            comments=2000,
+            seed=3,
+            stdout=StringIO(),
+        )
+
+        self.assertEqual(models.Movie.objects.count(), 200)
+        self.assertEqual(models.Comment.objects.count(), 2000)
+        self.assertEqual(User.objects.count(), 40)
+
+        # comments pile up on a few popular movies
+        counts = list(
+            models.Movie.objects.order_by("-rating_count").values_list(
+                "rating_count", flat=True
+            )
+        )
+        self.assertEqual(sum(counts), 2000)
+        self.assertGreater(counts[0], 10 * counts[100])
+
+        movie = models.Movie.objects.order_by("-rating_count").first()
+        self.assertAlmostEqual(
+            movie.average_rating,
+            sum(c.rating for c in movie.comments.all()) / movie.rating_count,
+        )
+        res = client.get(
+            "/movies/", data={"title_like": movie.title, "limit": 10}
+        )
+        self.assertEqual([m["id"] for m in res.json()], [movie.id])
+
+        # the dates come from the seed, not the current day
+        self.assertEqual(
+            set(models.Movie.objects.values_list("added_date", flat=True)),
+            {date(2021, 5, 2)},
+        )
+
+        # the stored image dimensions spare loading the default image
+        with mock.patch.object(
+            default_storage, "open", side_effect=AssertionError
+        ):
+            movies = list(models.Movie.objects.all())
+        self.assertEqual(
+            {(m.image_width, m.image_height) for m in movies},
+            {(movie.thumbnail.width, movie.thumbnail.height)},
+        )
+
+        # new rows continue after the generated ids
+        last_id = models.Movie.objects.order_by("-id").first().id
+        self.assertGreater(create_movie("after generation").id, last_id)
+
+
+class ProfilingTest(APITestCase):
+    def test_count_queries(self):
+        for i in range(5):
+            create_movie(f"counted {i}")
+
+        with profiling.count_queries() as stats:
+            list(models.Movie.objects.all())
+            models.Movie.objects.filter(title="counted 1").first()
+            models.Movie.objects.filter(title="missing").first()
+
+        self.assertEqual(stats.queries, 3)
+        self.assertEqual(stats.rows, 6)
+
+        # the connection gets its cursors back
+        with profiling.count_queries() as other:
+            pass
+        list(models.Movie.objects.all())
+        self.assertEqual((stats.queries, other.queries), (3, 0))
+
+    @override_settings(REQUEST_PROFILING=True, CATALOG_CACHE_TIMEOUT=0)
+    def test_profiling_middleware(self):
+        movie = create_movie("profiled")
+        user = User.objects.create_user("profiler", password="profiler")
+        create_comments(movie, user, 1, 2, 3)
+
+        # the middleware chain is built by the first request of a client
+        profiled_client = APIClient()
+        with self.assertLogs(profiling.logger, "INFO") as logs:
+            res = profiled_client.get(
+                "/movies/", data={"limit": 10, "representation": "full"}
+            )
+
+        timing = res["Server-Timing"]
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="3 queries"', timing)
+        self.assertIn("serializer;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+        report = json.loads(logs.records[0].getMessage())
+        self.assertEqual(report["path"], "/movies/")
+        self.assertEqual(report["queries"], 3)
+        self.assertGreater(report["serializer_ms"], 0)
+        self.assertEqual(report["duplicate_queries"], [])
+
+        # lazily loaded relations show up as duplicates
+        with profiling.count_queries() as stats:
+            for comment in models.Comment.objects.all():
+                comment.commented_movie.title
+        self.assertEqual(stats.duplicates(3)[0][1], 3)
+
+        with override_settings(REQUEST_PROFILING=False):
+            res = APIClient().get("/movies/")
+        self.assertNotIn("Server-Timing", res)
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("carol", password="carolpass")
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {"HTTP_AUTHORIZATION": "Token " + self.token.key}
+
+    def test_cached_lookup(self):
+        res = client.get("/auth/", **self.auth)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        with CaptureQueriesContext(connection) as queries:
+            res = client.get("/auth/", **self.auth)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 0)
+
+    def test_deactivated_user(self):
+        client.get("/auth/", **self.auth)
+        self.user.is_active = False
+        self.user.save()
+
+        res = client.get("/auth/", **self.auth)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_token(self):
+        client.get("/auth/", **self.auth)
+        self.token.delete()
+
+        res = client.get("/auth/", **self.auth)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(AUTH_TOKEN_SHARED_CACHE=True)
+    def test_shared_cache(self):
+        client.get("/auth/", **self.auth)
+        # another process only has the shared entry
+        authentication.token_cache.clear()
+
+        with CaptureQueriesContext(connection) as queries:
+            res = client.get("/auth/", **self.auth)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 0)
+
+        self.token.delete()
+        authentication.token_cache.clear()
+        res = client.get("/auth/", **self.auth)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_lru_bounds(self):
+        lru = authentication.TokenCache(size=2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual(
+            (lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3)
+        )
+
+        expired = authentication.TokenCache(size=2, ttl=-1)
+        expired.set("a", 1)
+        self.assertIsNone(expired.get("a"))
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class LeaderboardTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        leaderboards.board_states.clear()
+        # the board states outlive the rolled back boards
+        self.addCleanup(leaderboards.board_states.clear)
+        self.alice, _ = create_dummy_user("alice")
+        self.movies = [
+            create_movie(f"ranked movie no.:{i}", f"20{10 + i}-01-01")
+            for i in range(8)
+        ]
+        for i, movie in enumerate(self.movies):
+            create_comments(movie, self.alice, *[i % 5] * (i % 3))
+
+    def refresh(self, **kwargs) -> List[str]:
+        with self.captureOnCommitCallbacks(execute=True):
+            return leaderboards.refresh(**kwargs)
+
+    def ranking(self, sort_method: str, **params) -> Tuple[list, str]:
+        data = {"sort_method": sort_method, "limit": 8, **params}
+        res = client.get("/movies/", data=data)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return (
+            [movie["id"] for movie in res.json()],
+            res.get(leaderboards.REFRESHED_AT_HEADER),
+        )
+
+    def test_served_from_board(self):
+        live = {}
+        for sort_method in leaderboards.BOARDS:
+            live[sort_method], refreshed_at = self.ranking(sort_method)
+            self.assertIsNone(refreshed_at)
+
+        self.assertEqual(self.refresh(), list(leaderboards.BOARDS))
+
+        for sort_method in leaderboards.BOARDS:
+            with self.subTest(sort_method=sort_method):
+                ranking, refreshed_at = self.ranking(sort_method)
+                self.assertEqual(ranking, live[sort_method])
+                self.assertIsNotNone(refreshed_at)
+
+        # searches are not on the boards
+        self.assertIsNone(self.ranking("best", title_like="ranked")[1])
+
+        # walking the board with a cursor
+        ids = []
+        data = {"sort_method": "best", "pagination": "cursor", "limit": 3}
+        res = client.get("/movies/", data=data)
+        while True:
+            ids += [movie["id"] for movie in res.json()["results"]]
+            if res.json()["next"] is None:
+                break
+            res = client.get(res.json()["next"])
+        self.assertEqual(ids, live["best"])
+
+    def test_comments_dirty_rating_boards(self):
+        self.refresh()
+        self.assertEqual(self.refresh(), [])
+
+        last = self.movies[0]
+        create_comments(last, self.alice, 5, 5, 5)
+        # the ranking waits for the refresh
+        self.assertNotEqual(self.ranking("best")[0][0], last.id)
+
+        self.assertEqual(self.refresh(), ["best", "most_popular"])
+        self.assertEqual(self.ranking("best")[0][0], last.id)
+        self.assertEqual(self.ranking("most_popular")[0][0], last.id)
+
+    def test_updated_in_place(self):
+        self.refresh()
+        board = models.Leaderboard.objects.get(name="most_popular")
+        entries = dict(board.entries.values_list("movie", "pk"))
+
+        # moves one movie up two places past movies of another count
+        create_comments(self.movies[4], self.alice, 3)
+        self.refresh()
+
+        m = [movie.id for movie in self.movies]
+        self.assertEqual(
+            self.ranking("most_popular")[0],
+            [m[5], m[4], m[2], m[7], m[1], m[6], m[3], m[0]],
+        )
+        self.assertEqual(
+            dict(board.entries.values_list("movie", "pk")), entries
+        )
+
+        # a new movie at the top of "newest" shifts every rank
+        newest = models.Leaderboard.objects.get(name="newest")
+        create_movie("ranked movie no.:8", "2030-01-01")
+        self.refresh()
+        self.assertEqual(
+            newest.entries.get(rank=1).movie.title, "ranked movie no.:8"
+        )
+        self.assertEqual(newest.entries.count(), 9)
+
+    @override_settings(LEADERBOARD_STATE_TTL=60)
+    def test_refreshed_by_another_process(self):
+        self.assertIsNone(self.ranking("best")[1])
+
+        # e.g. by the Celery worker, this process keeps its states
+        with mock.patch.object(leaderboards.board_states, "clear"):
+            self.refresh()
+        self.assertIsNone(self.ranking("best")[1])
+
+        later = leaderboards.time.monotonic() + 60
+        with mock.patch.object(
+            leaderboards.time, "monotonic", return_value=later
+        ):
+            self.assertIsNotNone(self.ranking("best")[1])
+
+    def test_outdated_cursors(self):
+        data = {"sort_method": "best", "pagination": "cursor", "limit": 3}
+        live_page = client.get("/movies/", data=data).json()["next"]
+
+        # the board ranks rows differently than the live ordering
+        self.refresh()
+        res = client.get(live_page)
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+        board_page = client.get("/movies/", data=data).json()["next"]
+        self.assertEqual(client.get(board_page).status_code, 200)
+
+        # the ranks move when the board is rebuilt
+        self.refresh(force=True)
+        res = client.get(board_page)
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("Outdated cursor", res.json()["detail"])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class SparseFieldsetTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = User.objects.create_user("alice", "ali@ce.com", "alicepass")
+        for i in range(8):
+            movie = create_movie(f"fieldset movie no.:{i}")
+            create_comments(movie, alice, i % 5)
+
+    def test_compact_list(self):
+        res = client.get("/movies/")
+        movie = res.json()["results"][0]
+        self.assertNotIn("text", movie)
+        self.assertNotIn("genres", movie)
+        self.assertIn("average_rating", movie)
+
+        res = client.get("/movies/", data={"representation": "full"})
+        self.assertIn("text", res.json()["results"][0])
+
+        # details stay complete
+        res = client.get(f"/movies/{movie['id']}/")
+        self.assertIn("genres", res.json())
+
+    def test_movie_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = client.get(
+                "/movies/", data={"fields": "id,title", "limit": 8}
+            )
+        self.assertEqual(set(res.json()[0]), {"id", "title"})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"text"', queries[0]["sql"])
+
+        with CaptureQueriesContext(connection) as queries:
+            res = client.get(
+                "/movies/",
+                data={"exclude": "text,actors", "representation": "full"},
+            )
+        movie = res.json()["results"][0]
+        self.assertNotIn("text", movie)
+        self.assertNotIn("actors", movie)
+        self.assertIn("genres", movie)
+        # count + select + genres prefetch
+        self.assertEqual(len(queries), 3)
+
+        res = client.get("/movies/", data={"fields": "title,password"})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cursor_keeps_ordering_fields(self):
+        data = {
+            "pagination": "cursor",
+            "sort_method": "newest",
+            "fields": "title",
+            "limit": 3,
+        }
+        titles = []
+        res = client.get("/movies/", data=data)
+
+        while True:
+            titles += [m["title"] for m in res.json()["results"]]
+            if res.json()["next"] is None:
+                break
+
+            # deferred ordering columns would cost a query per row
+            with self.assertNumQueries(1):
+                res = client.get(res.json()["next"])
+
+        expected = models.Movie.objects.order_by("-produce_date", "-id")
+        self.assertEqual(titles, [m.title for m in expected])
+
+    def test_comment_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            res = client.get(
+                "/comments/", data={"fields": "rating,movie_title"}
+            )
+        self.assertEqual(
+            set(res.json()["results"][0]), {"rating", "movie_title"}
+        )
+        self.assertIn("filmdom_mvp_movie", queries[-1]["sql"])
+        self.assertNotIn("auth_user", queries[-1]["sql"])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0, BATCH_LOOKUP_MAX_IDS=5)
+class BatchLookupTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = User.objects.create_user("alice", "ali@ce.com", "alicepass")
+        cls.movies = [create_movie(f"batch movie no.:{i}") for i in range(6)]
+        cls.comments = [
+            create_comments(movie, alice, 3)[0] for movie in cls.movies
+        ]
+
+    def test_movie_batch(self):
+        ids = [self.movies[4].id, self.movies[1].id, self.movies[3].id]
+
+        # one select, no pagination count
+        with self.assertNumQueries(1):
+            res = client.get(
+                "/movies/", data={"ids": ",".join(map(str, ids))}
+            )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([m["id"] for m in res.json()], ids)
+
+        res = client.get(
+            "/movies/",
+            data={"ids": f"{ids[0]},999999,{ids[0]},{ids[2]}"},
+        )
+        self.assertEqual([m["id"] for m in res.json()], [ids[0], ids[2]])
+
+        res = client.get(
+            "/movies/",
+            data={"ids": ",".join(str(m.id) for m in self.movies)},
+        )
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        for ids in ("1,a", f"1,{2**63}", "0"):
+            with self.subTest(ids=ids):
+                res = client.get("/movies/", data={"ids": ids})
+                self.assertEqual(
+                    res.status_code, status.HTTP_400_BAD_REQUEST
+                )
+
+    def test_comment_batch(self):
+        ids = [self.comments[2].id, self.comments[0].id]
+
+        with self.assertNumQueries(1):
+            res = client.get(
+                "/comments/", data={"ids": ",".join(map(str, ids))}
+            )
+        self.assertEqual([c["id"] for c in res.json()], ids)
+        self.assertEqual(
+            res.json()[0]["movie_title"], self.movies[2].title
+        )
+
+
+@override_settings(DATABASE_REPLICAS=["replica"], REPLICA_MAX_LAG=2)
+class ReplicaRoutingTest(APITestCase):
+    def setUp(self):
+        replicas.replica_health.clear()
+        self.addCleanup(replicas.replica_health.clear)
+        self.router = replicas.ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def route(self, method: str, write: bool = False, **headers) -> str:
+        """
+        Passes a request through the middleware, returns the database
+        its view reads from
+        """
+        used = []
+
+        def view(request):
+            if write:
+                self.router.db_for_write(models.Comment)
+            used.append(self.router.db_for_read(models.Movie))
+            return None
+
+        request = self.factory.generic(method, "/movies/", **headers)
+        replicas.ReplicaMiddleware(view)(request)
+        return used[0]
+
+    def test_routing(self):
+        auth = {"HTTP_AUTHORIZATION": "Token pinned"}
+
+        with mock.patch.object(replicas, "replica_lag", return_value=0):
+            # no request, e.g. a Celery task
+            self.assertEqual(self.router.db_for_read(models.Movie), "default")
+            self.assertEqual(self.route("GET", **auth), "replica")
+            self.assertEqual(self.route("POST", **auth), "default")
+            # the client reads its own write from the primary
+            self.assertEqual(self.route("GET", **auth), "default")
+            self.assertEqual(self.route("GET"), "replica")
+            self.assertEqual(
+                self.route("GET", **{"HTTP_AUTHORIZATION": "Token other"}),
+                "replica",
+            )
+            # a write during a read request pins the rest of it
+            self.assertEqual(self.route("GET", write=True), "default")
+
+            # the pin expiring
+            cache.clear()
+            self.assertEqual(self.route("GET", **auth), "replica")
+
+    def test_replica_fallback(self):
+        with mock.patch.object(
+            replicas, "replica_lag", return_value=10
+        ) as lag:
+            self.assertEqual(self.route("GET"), "default")
+            self.assertEqual(self.route("GET"), "default")
+        # the check result is reused
+        self.assertEqual(lag.call_count, 1)
+
+        replicas.replica_health.clear()
+        with mock.patch.object(
+            replicas, "replica_lag", side_effect=OperationalError
+        ):
+            self.assertEqual(self.route("GET"), "default")
+
+        # requests keep working while the replica is out
+        user, token = create_dummy_user("dave")
+        movie = create_movie("routed")
+        res = client.post(
+            "/comments/",
+            {
+                "rating": 4,
+                "commented_movie": movie.id,
+                "creator": user.id,
+                "text": "read back from the primary",
+            },
+            HTTP_AUTHORIZATION="Token " + token,
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        res = client.get(f"/movies/{movie.id}/")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+
+class MirrorReplicaTest(TransactionTestCase):
+    """
+    Reads from a "mirror" connection to the test database, standing in
+    for a read replica streaming from the primary. The rows are
+    committed, the mirror would not see them inside a test transaction.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # added once the test database exists, so it opens that one
+        # and the other tests never see the alias
+        connections.settings["mirror"] = dict(
+            connections["default"].settings_dict
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        connections["mirror"].close()
+        del connections["mirror"]
+        del connections.settings["mirror"]
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        replicas.replica_health.clear()
+        self.addCleanup(replicas.replica_health.clear)
+
+    def databases_used(self, client: APIClient, *args, **kwargs) -> dict:
+        """
+        Queries of a GET per database, as reported by ProfilingMiddleware
+        """
+        with self.assertLogs(profiling.logger, "INFO") as logs:
+            res = client.get(*args, **kwargs)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return json.loads(logs.records[0].getMessage())["databases"]
+
+    @override_settings(
+        DATABASE_REPLICAS=["mirror"],
+        REQUEST_PROFILING=True,
+        CATALOG_CACHE_TIMEOUT=0,
+    )
+    def test_reads_from_replica(self):
+        movie = create_movie("mirrored", None, [], "mirror director", [])
+        alice, token = create_dummy_user("alice")
+        auth = {"HTTP_AUTHORIZATION": "Token " + token}
+        profiled_client = APIClient()
+
+        used = self.databases_used(profiled_client, "/movies/", **auth)
+        self.assertEqual(set(used), {"mirror"})
+        res = profiled_client.get(f"/movies/{movie.id}/")
+        self.assertEqual(res.json()["title"], "mirrored")
+
+        # the writer reads its own writes from the primary for a while
+        res = profiled_client.post(
+            "/comments/",
+            {
+                "rating": 4,
+                "commented_movie": movie.id,
+                "creator": alice.id,
+                "text": "read back",
+            },
+            **auth,
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        used = self.databases_used(
+            profiled_client, "/comments/", {"movie_id": movie.id}, **auth
+        )
+        self.assertEqual(set(used), {"default"})
+
+        # other clients keep reading from the replica
+        used = self.databases_used(profiled_client, "/comments/")
+        self.assertEqual(set(used), {"mirror"})
+
+
+class AsyncReadViewTest(TransactionTestCase):
+    # the async views query from worker threads, which do not
+    # see the transaction of a regular test case
+
+    def test_async_matches_sync(self):
+        alice = User.objects.create_user("alice", "ali@ce.com", "alicepass")
+        movies = [create_movie(f"async movie no.:{i}") for i in range(3)]
+        create_comments(movies[0], alice, 4, 5)
+        async_client = AsyncClient()
+
+        for path, data in (
+            ("/movies/", {"sort_method": "best"}),
+            (f"/movies/{movies[0].id}/", {}),
+            ("/comments/", {"movie_id": movies[0].id}),
+            ("/genres/", {}),
+        ):
+            with self.subTest(path=path):
+                # the async test client of Django 3.2 drops GET data
+                res = asyncio.run(
+                    async_client.get(f"/async{path}?{urlencode(data)}")
+                )
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                expected = client.get(path, data).json()
+                if isinstance(expected, dict) and "next" in expected:
+                    # next links point to the served path
+                    expected["next"] = res.json()["next"]
+                self.assertEqual(res.json(), expected)
+
+        res = asyncio.run(async_client.post("/async/movies/", {}))
+        self.assertEqual(res.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_concurrent_requests(self):
+        in_flight = []
+        peak = []
+        genre_list = views.MovieGenreViewSet.list
+
+        def slow_list(viewset, request, *args, **kwargs):
+            in_flight.append(request)
+            peak.append(len(in_flight))
+            time.sleep(0.3)
+            in_flight.remove(request)
+            return genre_list(viewset, request, *args, **kwargs)
+
+        async def run():
+            async_client = AsyncClient()
+            return await asyncio.gather(
+                *(async_client.get("/async/genres/") for _ in range(4))
+            )
+
+        with mock.patch.object(views.MovieGenreViewSet, "list", slow_list):
+            start = time.perf_counter()
+            responses = asyncio.run(run())
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([res.status_code for res in responses], [200] * 4)
+        # one at a time they would take 1.2 seconds
+        self.assertEqual(max(peak), 4)
+        self.assertLess(elapsed, 0.9)
+
+    @override_settings(REQUEST_PROFILING=True)
+    def test_profiled_async_view(self):
+        models.MovieGenre.objects.create(name="drama")
+
+        # the view queries from a worker thread, outside the middleware
+        with self.assertLogs(profiling.logger, "INFO") as logs:
+            res = asyncio.run(AsyncClient().get("/async/genres/"))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn('desc="1 queries"', res["Server-Timing"])
+        report = json.loads(logs.records[0].getMessage())
+        self.assertEqual(report["databases"], {"default": 1})
@@ -0,0 +1,231 @@
+"""
+Downscaled variants of the movie thumbnails.
+
+The full size posters (uploaded ones and the originals on TMDB) are
+far bigger than a grid of movies needs. The `create_thumbnail_variants`
+task periodically finds the movies whose thumbnail has no variants
+yet, downloads or opens it and stores a JPEG for each of the
+THUMBNAIL_VARIANTS, shrunk to fit its bounding box.
+
+The variants are stored on the movie row, like the rating aggregates,
+so listing them costs no query. `thumbnail_variants_source` remembers
+the image they were made from; a movie whose thumbnail changes is
+processed again. One whose thumbnail is missing, too large or can not
+be decoded is not. A download failing on a timeout or a server error
+is retried after THUMBNAIL_RETRY_BACKOFF seconds, doubled with every
+failed attempt, and movies that failed less often are picked first.
+A movie whose thumbnail changes while it waits keeps waiting.
+
+The files are named by the hash of their content, so they can be
+cached forever and movies sharing a poster share the files. For the
+same reason the files are not removed with their movie.
+"""
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Case, CharField, F, Q, When
+from django.utils import timezone
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO
+from PIL import Image, ImageOps
+from typing import Dict, List, Optional, Tuple
+import aiohttp
+from . import cache, fetcher
+from .models import Movie
+
+DEFAULT_THUMBNAIL = Movie._meta.get_field("thumbnail").default
+UPLOAD_DIRECTORY = "thumbnails"
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+def source_expression() -> Case:
+    """
+    The image the variants are made from: the uploaded thumbnail,
+    the remote one otherwise
+    """
+    return Case(
+        When(
+            ~Q(thumbnail=DEFAULT_THUMBNAIL) & ~Q(thumbnail=""),
+            then=F("thumbnail"),
+        ),
+        default=F("remote_thumbnail"),
+        output_field=CharField(),
+    )
+
+
+def pending_movies(limit: int) -> List[Tuple[int, str]]:
+    """
+    Movies with a thumbnail that has not been processed yet and is not
+    waiting for a retry, as (id, source) pairs
+    """
+    return list(
+        Movie.objects.annotate(variants_source=source_expression())
+        .exclude(variants_source=None)
+        .exclude(variants_source="")
+        .exclude(thumbnail_variants_source=F("variants_source"))
+        .exclude(thumbnail_variants_retry_at__gt=timezone.now())
+        .order_by("thumbnail_variants_attempts", "id")
+        .values_list("id", "variants_source")[:limit]
+    )
+
+
+def is_remote(source: str) -> bool:
+    return "://" in source
+
+
+def make_variants(data: bytes) -> Dict[str, Tuple[bytes, int, int]]:
+    """
+    Encodes every variant of the image, as (content, width, height)
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ThumbnailError(f"Can not read the image: {e}")
+
+    if image.mode in ("RGBA", "LA", "P"):
+        # JPEG has no transparency
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    variants = {}
+
+    for name, size in settings.THUMBNAIL_VARIANTS.items():
+        variant = image.copy()
+        # never enlarges, the aspect ratio is kept
+        variant.thumbnail(size, Image.LANCZOS)
+        output = BytesIO()
+        variant.save(
+            output,
+            "JPEG",
+            quality=settings.THUMBNAIL_QUALITY,
+            optimize=True,
+            progressive=True,
+        )
+        variants[name] = (output.getvalue(), *variant.size)
+
+    return variants
+
+
+def store_file(content: bytes) -> str:
+    name = f"{UPLOAD_DIRECTORY}/{sha256(content).hexdigest()}.jpg"
+
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(content))
+
+    return name
+
+
+def save_variants(
+    movie_id: int,
+    source: str,
+    variants: Optional[Dict[str, Tuple[bytes, int, int]]],
+):
+    """
+    Replaces the variants of a movie, None records a failed source
+    """
+    stored = {
+        name: {"image": store_file(content), "width": width, "height": height}
+        for name, (content, width, height) in (variants or {}).items()
+    }
+
+    # update() skips the movie signals, nothing else has changed
+    Movie.objects.filter(pk=movie_id).update(
+        thumbnail_variants=stored,
+        thumbnail_variants_source=source,
+        thumbnail_variants_attempts=0,
+        thumbnail_variants_retry_at=None,
+    )
+    cache.bump_versions("movies", f"movies:{movie_id}")
+
+
+def postpone(movie_id: int):
+    """
+    Backs off from a movie whose source failed on a transient error
+    """
+    movies = Movie.objects.filter(pk=movie_id)
+    attempts = movies.values_list(
+        "thumbnail_variants_attempts", flat=True
+    ).first()
+
+    if attempts is None:
+        return
+
+    delay = min(
+        settings.THUMBNAIL_RETRY_BACKOFF * 2**attempts,
+        settings.THUMBNAIL_RETRY_MAX_BACKOFF,
+    )
+    movies.update(
+        thumbnail_variants_attempts=attempts + 1,
+        thumbnail_variants_retry_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def read_upload(name: str) -> bytes:
+    try:
+        with default_storage.open(name) as file:
+            return file.read()
+    except OSError as e:
+        raise ThumbnailError(f"Can not open {name}: {e}")
+
+
+async def process_movie(
+    session: aiohttp.ClientSession,
+    bucket: fetcher.TokenBucket,
+    movie_id: int,
+    source: str,
+):
+    try:
+        if is_remote(source):
+            data = await fetcher.get_bytes(
+                session, source, bucket, settings.THUMBNAIL_MAX_SOURCE_SIZE
+            )
+        else:
+            data = await sync_to_async(read_upload)(source)
+
+        # decoding and resizing runs in a thread, the loop keeps
+        # downloading meanwhile
+        resize = sync_to_async(make_variants, thread_sensitive=False)
+        variants = await resize(data)
+    except fetcher.FetchError as e:
+        if e.permanent:
+            await sync_to_async(save_variants)(movie_id, source, None)
+        else:
+            await sync_to_async(postpone)(movie_id)
+        raise
+    except ThumbnailError:
+        await sync_to_async(save_variants)(movie_id, source, None)
+        raise
+
+    await sync_to_async(save_variants)(movie_id, source, variants)
+
+
+async def create_pending_variants(limit: int) -> dict:
+    """
+    Makes the variants of at most `limit` pending movies,
+    returns the counts of processed and failed ones
+    """
+    pending = await sync_to_async(pending_movies)(limit)
+    bucket = fetcher.TokenBucket(settings.TMDB_REQUESTS_PER_SECOND)
+
+    async def entries():
+        for entry in pending:
+            yield entry
+
+    async with fetcher.create_session() as session:
+        return await fetcher.run_bounded(
+            entries(),
+            lambda entry: process_movie(session, bucket, *entry),
+            settings.THUMBNAIL_CONCURRENCY,
+        )
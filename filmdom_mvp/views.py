@@ -1,11 +1,11 @@
 from django.contrib.auth.models import User, Group
-from django.db.models import Avg, Count
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import permissions
 from rest_framework import viewsets
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ValidationError
 from filmdom_mvp.serializers import (
     ActorSerializer,
     CommentSerializer,
@@ -20,6 +20,20 @@ from filmdom_mvp.serializers import (
     Movie,
     Comment,
 )
+from filmdom_mvp.models import (
+    BEST_RATING_KEY,
+    RATING_BUCKETS,
+    SHUFFLE_SEEDS,
+    WORST_RATING_KEY,
+    rating_bucket_field,
+    shuffle_key,
+)
+from filmdom_mvp import search
+from filmdom_mvp.batch import BatchLookupMixin
+from filmdom_mvp.cache import CachedResponseMixin
+from filmdom_mvp.fieldsets import SparseFieldsetMixin
+from filmdom_mvp.leaderboards import REFRESHED_AT_HEADER, LeaderboardMixin
+from filmdom_mvp.pagination import KeysetPaginationMixin
 from filmdom_mvp.permissions import (
     CreationAllowed,
     IsOwnerOrReadonly,
@@ -53,10 +67,51 @@ class GroupViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class MovieViewSet(viewsets.ModelViewSet):
+class MovieViewSet(
+    CachedResponseMixin,
+    LeaderboardMixin,
+    KeysetPaginationMixin,
+    SparseFieldsetMixin,
+    BatchLookupMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Movie.objects.all().order_by("title")
     serializer_class = MovieSerializer
     permission_classes = [ReadOnly | permissions.IsAdminUser]
+    # lists depend on the ratings of every movie, a detail view
+    # only on its own (bumped as the "movies:<pk>" version)
+    cache_namespaces = ("movies", "ratings", "leaderboards")
+    detail_cache_namespaces = ("movies",)
+    cached_headers = (REFRESHED_AT_HEADER,)
+    # what a grid of movies shows
+    list_fields = [
+        "id",
+        "title",
+        "produce_date",
+        "thumbnail",
+        "remote_thumbnail",
+        "thumbnail_variants",
+        "average_rating",
+        "rating_count",
+    ]
+    field_columns = {
+        "director_name": ["director__name"],
+        # the image dimensions are read along with the image
+        "thumbnail": ["thumbnail", "image_width", "image_height"],
+        "rating_histogram": [
+            rating_bucket_field(bucket) for bucket in RATING_BUCKETS
+        ],
+    }
+    field_select_related = {"director_name": "director"}
+    field_prefetch_related = {"genres": "genres", "actors": "actors"}
+
+    def is_cacheable(self, request) -> bool:
+        # a random order without a seed is supposed to change every time
+        params = request.query_params
+        if params.get("sort_method") == "random" and "seed" not in params:
+            return False
+
+        return super().is_cacheable(request)
 
     @staticmethod
     def validate_limit(limit) -> bool:
@@ -77,39 +132,73 @@ class MovieViewSet(viewsets.ModelViewSet):
         limit = self.request.query_params.get("limit")
         sort_method = self.request.query_params.get("sort_method")
         title_like = self.request.query_params.get("title_like")
-
-        if sort_method == "best":
-            queryset = Movie.objects.annotate(
-                avg_score=Avg("comments__rating")
-            ).order_by("-avg_score")
+        seed = self.request.query_params.get("seed")
+
+        movies = Movie.objects.all()
+        ids = self.requested_ids()
+        leaderboard = None
+
+        # the popular sorts come precomputed when they are not narrowed
+        if self.action == "list" and not title_like and ids is None:
+            leaderboard = self.leaderboard_queryset(sort_method)
+
+        # every ordering ends with a unique column, which keeps
+        # pages stable and lets them be paginated with a cursor
+        if leaderboard is not None:
+            queryset = leaderboard
+        elif sort_method == "best":
+            queryset = movies.annotate(rating_key=BEST_RATING_KEY).order_by(
+                "-rating_key", "-id"
+            )
         elif sort_method == "worst":
-            queryset = Movie.objects.annotate(
-                avg_score=Avg("comments__rating")
-            ).order_by("avg_score")
+            queryset = movies.annotate(rating_key=WORST_RATING_KEY).order_by(
+                "rating_key", "id"
+            )
         elif sort_method == "most_popular":
-            queryset = Movie.objects.annotate(
-                no_of_comments=Count("comments")
-            ).order_by("-no_of_comments")
+            queryset = movies.order_by("-rating_count", "-id")
         elif sort_method == "least_popular":
-            queryset = Movie.objects.annotate(
-                no_of_comments=Count("comments")
-            ).order_by("no_of_comments")
+            queryset = movies.order_by("rating_count", "id")
         elif sort_method == "newest":
-            queryset = Movie.objects.all().order_by("-produce_date")
+            queryset = movies.order_by("-produce_date", "-id")
         elif sort_method == "oldest":
-            queryset = Movie.objects.all().order_by("produce_date")
+            queryset = movies.order_by("produce_date", "id")
         elif sort_method == "random":
-            queryset = sorted(
-                Movie.objects.all(), key=lambda x: random.random()
+            # without a seed every request gets a fresh shuffle,
+            # so paging through it needs one
+            if seed is None:
+                if self.uses_keyset_pagination():
+                    raise ValidationError(
+                        "sort_method=random requires a seed "
+                        "with cursor pagination"
+                    )
+                seed = random.randrange(SHUFFLE_SEEDS)
+
+            queryset = movies.annotate(shuffle_key=shuffle_key(seed)).order_by(
+                "shuffle_key", "id"
+            )
+        elif sort_method == "relevance" and title_like:
+            queryset = search.annotate_relevance(movies, title_like).order_by(
+                "-relevance", "id"
             )
         else:
-            queryset = Movie.objects.all().order_by("title")
+            queryset = movies.order_by("title")
 
         if title_like:
-            try:
-                queryset = queryset.filter(title__icontains=title_like)
-            except AttributeError:
-                pass
+            queryset = search.search_movies(queryset, title_like)
+
+        if ids is not None:
+            queryset = self.filter_requested_ids(queryset, ids)
+
+        # everything the serializer touches is loaded up front, so a page
+        # costs the same number of queries regardless of its size
+        queryset = self.trim_queryset(queryset)
+
+        if ids is not None:
+            return queryset
+
+        # with cursor pagination limit sets the page size instead
+        if self.uses_keyset_pagination():
+            return queryset
 
         if MovieViewSet.validate_limit(limit):
             self._paginator = None
@@ -118,13 +207,26 @@ class MovieViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(
+    KeysetPaginationMixin,
+    SparseFieldsetMixin,
+    BatchLookupMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = [IsOwnerOrReadonly]
+    field_columns = {
+        "creator_name": ["creator__username"],
+        "movie_title": ["commented_movie__title"],
+    }
+    field_select_related = {
+        "creator_name": "creator",
+        "movie_title": "commented_movie",
+    }
 
     def get_queryset(self):
-        queryset = Comment.objects.all().order_by("created")
+        queryset = Comment.objects.all()
         limit = self.request.query_params.get("limit")
         order_by = self.request.query_params.get("sort_method")
         title = self.request.query_params.get("title")
@@ -143,7 +245,9 @@ class CommentViewSet(viewsets.ModelViewSet):
                 pass
         elif title_like not in (None, ""):
             queryset = queryset.filter(
-                commented_movie__title__icontains=title_like
+                commented_movie__in=search.search_movies(
+                    Movie.objects.all(), title_like
+                ).values("id")
             )
 
         if user is not None:
@@ -155,13 +259,20 @@ class CommentViewSet(viewsets.ModelViewSet):
             except ValueError:
                 pass
 
-        if order_by is not None:
-            if order_by == "newest":
-                queryset = queryset[::-1]
-            elif order_by == "oldest":
-                ...
+        # `created` is just a date, the id keeps comments from
+        # the same day in a stable order
+        if order_by == "newest":
+            queryset = queryset.order_by("-created", "-id")
+        else:
+            queryset = queryset.order_by("created", "id")
+
+        ids = self.requested_ids()
+        if ids is not None:
+            return self.trim_queryset(self.filter_requested_ids(queryset, ids))
+
+        queryset = self.trim_queryset(queryset)
 
-        if limit is not None:
+        if limit is not None and not self.uses_keyset_pagination():
             try:
                 limit = int(limit)
                 queryset = queryset[:limit]
@@ -172,25 +283,28 @@ class CommentViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class DirectorViewSet(viewsets.ModelViewSet):
+class DirectorViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Director.objects.all().order_by("name")
     serializer_class = DirectorSerializer
     permission_classes = [ReadOnly | permissions.IsAdminUser]
     pagination_class = None
+    cache_namespaces = ("directors",)
 
 
-class ActorViewSet(viewsets.ModelViewSet):
+class ActorViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Actor.objects.all().order_by("name")
     serializer_class = ActorSerializer
     permission_classes = [ReadOnly | permissions.IsAdminUser]
     pagination_class = None
+    cache_namespaces = ("actors",)
 
 
-class MovieGenreViewSet(viewsets.ModelViewSet):
+class MovieGenreViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = MovieGenre.objects.all().order_by("name")
     serializer_class = MovieGenreSerializer
     permission_classes = [ReadOnly | permissions.IsAdminUser]
     pagination_class = None
+    cache_namespaces = ("genres",)
 
 
 class AuthTestView(APIView):